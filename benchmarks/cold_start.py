@@ -0,0 +1,145 @@
+# Cold-start benchmark for railway-fastapi-torch-macos122: startup time with an empty, partial and warm weight cache
+# Serves randomly initialised weights from a local stand-in for download.pytorch.org (Range requests, optional
+# bandwidth limit and dropped connections), so it runs offline and never downloads the real files.
+# Usage: python benchmarks/cold_start.py [--model resnet18] [--bandwidth-mbps 200] [--repeat 3]
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(template="railway-fastapi-torch-macos122"):
+    """
+    Import a template's app.py (it expects to run from its own folder)
+    """
+    template_dir = os.path.join(repo_root, template)
+    os.chdir(template_dir)
+    sys.path.insert(0, template_dir)
+    import app
+    return app
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """
+    Static files with "Range: bytes=N-" support, a bandwidth limit and a way to drop the connection mid-file
+    """
+    bandwidth = 0  # bytes per second, 0 = unlimited
+    drop_after = 0  # close the next response after this many bytes, 0 = never
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        offset = int(match.group(1)) if match else 0
+        type(self).requests.append({"path": self.path, "offset": offset})
+        if offset >= size and match:
+            return self.send_error(416)
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Length", str(size - offset))
+        if match:
+            self.send_header("Content-Range", f"bytes {offset}-{size - 1}/{size}")
+        self.end_headers()
+        drop_after, type(self).drop_after = type(self).drop_after, 0
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                if drop_after and sent + len(chunk) > drop_after:
+                    self.wfile.write(chunk[:drop_after - sent])
+                    self.close_connection = True
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.bandwidth:
+                    time.sleep(len(chunk) / self.bandwidth)
+
+
+def serve(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), lambda *a: RangeHandler(*a, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_app(app, weights_dir, offline=False):
+    """
+    Run the app's startup with fresh model state and a weight cache at weights_dir, returns its timings
+    """
+    from fastapi.testclient import TestClient
+
+    app.weight_cache = app.WeightCache(weights_dir, mirror=app.weights_mirror, offline=offline, pinned=app.weight_cache.pinned)
+    app.model_registry = app.ModelRegistry(app.model_memory_budget, app.model_warmup_batch)
+    app.batchers.clear()
+    start = time.perf_counter()
+    with TestClient(app.app) as client:
+        ready = time.perf_counter() - start
+        stats = client.get("/models/stats").json()
+    return {"ready_s": round(ready, 3), **stats["startup"], "weights": stats["weights"]["downloads"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start of the torch template against a local weight server")
+    parser.add_argument("--model", default="resnet18")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0, help="limit the stand-in server, 0 = unlimited")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    served = os.path.join(work, "served")
+    os.makedirs(served)
+    os.environ.update({"MODEL_NAME": args.model, "MODEL_PRELOAD": args.model, "EXECUTOR": "thread"})
+    RangeHandler.bandwidth = args.bandwidth_mbps * 125000
+    server = serve(served)
+    os.environ["WEIGHTS_MIRROR"] = f"http://127.0.0.1:{server.server_port}"
+    app = load_app()
+    import torch
+
+    # Random weights under the real file name, pinned by their full SHA-256 (the name's hash prefix won't match)
+    builder, weights = app.MODEL_BUILDERS[args.model]
+    filename = weights.url.rsplit("/", 1)[-1]
+    torch.save(builder(weights=None).state_dict(), os.path.join(served, filename))
+    with open(os.path.join(served, filename), "rb") as f:
+        data = f.read()
+    app.weight_cache.pinned = {filename: hashlib.sha256(data).hexdigest()}
+
+    report = {"model": args.model, "weights_bytes": len(data), "bandwidth_mbps": args.bandwidth_mbps, "runs": {}}
+    try:
+        for run in range(args.repeat):
+            cache = os.path.join(work, f"weights-{run}")
+            RangeHandler.requests = []
+            RangeHandler.drop_after = len(data) // 2
+            interrupted = start_app(app, cache)  # empty cache, the connection drops halfway and the download resumes
+            interrupted["requests"] = list(RangeHandler.requests)
+            shutil.rmtree(cache)
+            results = {
+                "cold": start_app(app, cache),
+                "interrupted": interrupted,
+                "warm": start_app(app, cache),
+                "offline": start_app(app, cache, offline=True),
+            }
+            for name, result in results.items():
+                report["runs"].setdefault(name, []).append(result)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+    summary = {name: min(r["ready_s"] for r in runs) for name, runs in report["runs"].items()}
+    print(json.dumps({**report, "best_ready_s": summary}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
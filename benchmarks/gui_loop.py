@@ -0,0 +1,107 @@
+# GUI loop benchmark for flask-dpg-macos122: process CPU of the old fixed 10 ms loop vs the adaptive render scheduler
+# Phases: idle (no state changes) and active (POST /gui/start through Flask at --event-rate per second).
+# Renders real DearPyGUI frames when a display is available, otherwise measures the loop alone ("render": "none").
+# Usage: python benchmarks/gui_loop.py [--seconds 5] [--event-rate 20]
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(template="flask-dpg-macos122"):
+    """
+    Import a template's app.py (it expects to run from its own folder)
+    """
+    template_dir = os.path.join(repo_root, template)
+    os.chdir(template_dir)
+    sys.path.insert(0, template_dir)
+    import app
+    return app
+
+
+def renderer(app):
+    """
+    (name, render function): DearPyGUI frames when a viewport can be created, a no-op otherwise
+    """
+    try:
+        dpg = app.create_gui()
+    except Exception:
+        dpg = None
+    if dpg is None:
+        return "none", lambda: None
+    app.dpg_context = dpg
+    return "dearpygui", dpg.render_dearpygui_frame
+
+
+def measure(step, seconds, post_events=None):
+    """
+    Process CPU percent and loop iterations while calling step() for seconds, posting events from a thread
+    """
+    stop = threading.Event()
+    poster = threading.Thread(target=post_events, args=(stop,), daemon=True) if post_events else None
+    if poster:
+        poster.start()
+    iterations = 0
+    wall, cpu = time.monotonic(), time.process_time()
+    while time.monotonic() - wall < seconds:
+        step()
+        iterations += 1
+    elapsed = time.monotonic() - wall
+    cpu_percent = (time.process_time() - cpu) / elapsed * 100
+    stop.set()
+    if poster:
+        poster.join()
+    return {"cpu_percent": round(cpu_percent, 2), "frames_per_s": round(iterations / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU use of the flask-dpg GUI loops")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--event-rate", type=float, default=20, help="state changes per second in the active phase")
+    args = parser.parse_args()
+
+    app = load_app()
+    render_name, render = renderer(app)
+    client = app.app.test_client()
+
+    def post_events(stop):
+        while not stop.wait(1 / args.event_rate):
+            client.post("/gui/start")  # sets server_status and wakes the GUI loop, like a real request
+
+    def fixed_loop():
+        render()
+        time.sleep(0.01)
+
+    def drain_events(stop):
+        post_events(stop)
+        while not app.gui_events.empty():
+            app.gui_events.get_nowait()
+
+    scheduler = app.RenderScheduler(render, lambda kind, data: None, app.gui_events,
+                                    app.GUI_IDLE_FPS, app.GUI_ACTIVE_FPS, app.GUI_ACTIVE_SECONDS)
+    scheduler.last_activity = float("-inf")
+    report = {
+        "render": render_name,
+        "idle_fps": app.GUI_IDLE_FPS,
+        "active_fps": app.GUI_ACTIVE_FPS,
+        "event_rate": args.event_rate,
+        "fixed_10ms": {
+            "idle": measure(fixed_loop, args.seconds),
+            "active": measure(fixed_loop, args.seconds, drain_events),  # the old loop ignores the events
+        },
+        "adaptive": {
+            "idle": measure(scheduler.run_once, args.seconds),
+            "active": measure(scheduler.run_once, args.seconds, post_events),
+        },
+    }
+    report["adaptive"]["events_handled"] = scheduler.events_handled
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
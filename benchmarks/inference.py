@@ -0,0 +1,117 @@
+# Inference backend benchmark for railway-fastapi-torch-macos122: accuracy vs latency
+# Usage: python benchmarks/inference.py [--backends eager,int8,torchscript] [--images DIR] [--batch-size 8]
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(template="railway-fastapi-torch-macos122"):
+    """
+    Import a template's app.py (it expects to run from its own folder)
+    """
+    template_dir = os.path.join(repo_root, template)
+    os.chdir(template_dir)
+    sys.path.insert(0, template_dir)
+    import app
+    return app
+
+
+def synthetic_images(count, size=512):
+    """
+    Deterministic image set (shapes on gradients), used when no --images folder is given
+    """
+    images = []
+    for i in range(count):
+        img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        colour = ((i * 67) % 256, (i * 131) % 256, (i * 197) % 256)
+        offset = (i * 37) % (size // 2)
+        draw.ellipse((offset, offset, offset + size // 2, offset + size // 3), fill=colour)
+        draw.rectangle((size - offset - size // 4, offset, size - offset, offset + size // 4), outline=colour, width=8)
+        images.append((f"synthetic-{i:02d}", img))
+    return images
+
+
+def folder_images(folder):
+    names = sorted(n for n in os.listdir(folder) if n.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+    return [(name, Image.open(os.path.join(folder, name)).convert("RGB")) for name in names]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def run_backend(app, torch, name, backend, batch, batch_size, repeat):
+    loaded = app.build_model(name, backend)
+    with torch.inference_mode():
+        loaded.model(batch[:1])  # warm up allocator and lazy initialisation
+        single = []
+        for _ in range(repeat):
+            for i in range(len(batch)):
+                start = time.perf_counter()
+                loaded.model(batch[i:i + 1])
+                single.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        outputs = [loaded.model(batch[i:i + batch_size]) for i in range(0, len(batch), batch_size)]
+        batched_s = time.perf_counter() - start
+    probabilities = torch.cat(outputs).softmax(1)
+    return loaded, probabilities, {
+        "load_s": round(loaded.load_seconds, 2),
+        "rss_delta_mb": round(loaded.rss_delta_bytes / 2**20, 1) if loaded.rss_delta_bytes is not None else None,
+        "batch1_p50_ms": round(statistics.median(single), 2),
+        "batch1_p95_ms": round(percentile(single, 95), 2),
+        f"batch{batch_size}_images_per_s": round(len(batch) / batched_s, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inference backends of the torch template")
+    parser.add_argument("--model", default="vit_l_32")
+    parser.add_argument("--backends", default="eager,int8,torchscript,compile,onnx")
+    parser.add_argument("--images", help="folder of images, defaults to 32 synthetic images")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    app = load_app()
+    import torch
+
+    images = folder_images(args.images) if args.images else synthetic_images(32)
+    preprocess = app.MODEL_BUILDERS[args.model][1].transforms()
+    batch = torch.stack([preprocess(img) for _, img in images])
+
+    report = {"model": args.model, "images": len(images), "torch_threads": torch.get_num_threads(), "backends": {}}
+    reference = None
+    for backend in args.backends.split(","):
+        try:
+            loaded, probabilities, result = run_backend(app, torch, args.model, backend, batch, args.batch_size, args.repeat)
+        except Exception as e:  # e.g. onnxruntime not installed
+            report["backends"][backend] = {"error": str(e)}
+            continue
+        if reference is None:
+            reference = probabilities  # accuracy is measured as agreement with the first backend (eager fp32)
+        top1 = (probabilities.argmax(1) == reference.argmax(1)).float().mean().item()
+        top5 = torch.topk(probabilities, 5).indices
+        top5_ref = torch.topk(reference, 5).indices
+        overlap = sum(len(set(a.tolist()) & set(b.tolist())) for a, b in zip(top5, top5_ref)) / (5 * len(images))
+        result.update({
+            "top1_agreement": round(top1, 4),
+            "top5_overlap": round(overlap, 4),
+            "max_prob_diff": round((probabilities - reference).abs().max().item(), 5),
+        })
+        report["backends"][backend] = result
+        del loaded
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+# Load test for the server templates: boots each app on localhost and drives it with concurrent clients
+# Scenarios: health (GET), upload (/uploadimages/ with synthetic JPEGs), classify (/process-last-image),
+# fanout (Socket.IO main_socket broadcast to N clients). Reports RPS, p50/p95/p99 latency and server RSS as JSON.
+# Usage: python benchmarks/load.py [--templates all] [--scenarios health,upload] [--concurrency 16] [--requests 500]
+#        [--clients 20] [--messages 200] [--env MODEL_NAME=resnet18] [--output run.json] [--baseline old.json]
+# Needs httpx and python-socketio (plus websocket-client for the websocket transport, otherwise it long-polls).
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEMPLATES = {
+    "fastapi-web-macos122": {"kind": "asgi", "health": "/health", "scenarios": ["health", "upload"]},
+    "railway-fastapi-torch-macos122": {"kind": "asgi", "health": "/models", "scenarios": ["health", "upload", "classify"]},
+    "flask-web-macos122": {"kind": "socketio", "health": "/health", "scenarios": ["health", "fanout"]},
+    "flask-web": {"kind": "socketio", "health": "/", "scenarios": ["health", "fanout"]},
+    "flask-dpg-macos122": {"kind": "wsgi", "health": "/health", "scenarios": ["health"]},
+}
+
+
+def serve(template, port):
+    """
+    Run one template's app on 127.0.0.1:port (the harness starts this in a subprocess)
+    """
+    template_dir = os.path.join(repo_root, template)
+    os.chdir(template_dir)
+    sys.path.insert(0, template_dir)
+    import app as module
+
+    kind = TEMPLATES[template]["kind"]
+    if kind == "asgi":
+        import uvicorn
+        uvicorn.run(module.app, host="127.0.0.1", port=port, log_level="warning")
+    elif kind == "socketio" and getattr(module, "WORKERS", 1) > 1:
+        module.serve_workers("127.0.0.1", port, module.WORKERS)  # pre-forked workers sharing a message queue
+    elif kind == "socketio":
+        try:
+            module.socketio.run(module.app, host="127.0.0.1", port=port, allow_unsafe_werkzeug=True)
+        except TypeError:  # Flask-SocketIO versions without the flag
+            module.socketio.run(module.app, host="127.0.0.1", port=port)
+    elif hasattr(module, "run_headless"):
+        module.run_headless("127.0.0.1", port)  # WSGI_SERVER picks the backend
+    else:
+        from werkzeug.serving import run_simple
+        run_simple("127.0.0.1", port, module.app, threaded=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:  # macOS
+        return int(subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)]).strip()) * 1024
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+class RssSampler:
+    """
+    Polls the server's resident memory in the background, keeps the peak
+    """
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.start_bytes = rss_bytes(pid)
+        self.peak_bytes = self.start_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            value = rss_bytes(self.pid)
+            if value is not None:
+                self.peak_bytes = max(self.peak_bytes or 0, value)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        end = rss_bytes(self.pid)
+        mb = lambda v: round(v / 2**20, 1) if v is not None else None
+        return {"rss_mb_start": mb(self.start_bytes), "rss_mb_peak": mb(self.peak_bytes), "rss_mb_end": mb(end)}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))] if ordered else None
+
+
+def latency_summary(latencies_s):
+    ms = [v * 1000 for v in latencies_s]
+    return {
+        "p50_ms": round(statistics.median(ms), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 2) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 2) if ms else None,
+        "max_ms": round(max(ms), 2) if ms else None,
+    }
+
+
+def synthetic_jpegs(count, size=(1024, 768)):
+    """
+    Distinct JPEGs (so the torch result cache doesn't turn the run into cache hits)
+    """
+    from PIL import Image, ImageDraw
+
+    base = Image.linear_gradient("L").resize(size).convert("RGB")
+    images = []
+    for i in range(count):
+        img = base.copy()
+        ImageDraw.Draw(img).rectangle((i % size[0], 0, i % size[0] + 64, 64), fill=((i * 67) % 256, (i * 131) % 256, 255))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+async def drive_http(base_url, method, path, total, concurrency, make_files=None):
+    """
+    total requests from concurrency workers sharing one connection pool (and one session cookie)
+    """
+    import httpx
+
+    latencies, errors, counter = [], [], iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        async def worker():
+            for i in counter:
+                files = make_files(i) if make_files else None
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, files=files)
+                    if response.status_code >= 400:
+                        errors.append(response.status_code)
+                        continue
+                except httpx.HTTPError as e:
+                    errors.append(type(e).__name__)
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2),
+        **latency_summary(latencies),
+        "errors": len(errors),
+        "error_kinds": sorted({str(e) for e in errors}),
+    }
+
+
+def drive_fanout(base_url, clients, messages, publishers, payload_bytes, timeout=60, data=None, serializer="default"):
+    """
+    clients Socket.IO connections receive every main_socket message sent by the publishers (which are
+    also clients); latency is from emit to each delivery, all measured with this process's clock.
+    data replaces the payload_bytes string padding (e.g. bytes or a list of floats), serializer must match the server.
+    """
+    import engineio.payload
+    import socketio
+
+    # A long-polling GET returns everything queued for the client, far more than 16 packets under broadcast load
+    engineio.payload.Payload.max_decode_packets = 4096
+    try:
+        import websocket  # noqa: F401 (websocket-client, python-socketio's websocket transport)
+        transports = ["websocket"]  # also the only transport the multi-worker mode accepts
+    except ImportError:
+        transports = ["polling"]
+    expected = clients * messages
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+    connections = []
+    for _ in range(clients):
+        client = socketio.Client(reconnection=False, serializer=serializer)
+
+        @client.on("exchange")
+        def on_exchange(data):
+            now = time.perf_counter()
+            with lock:
+                # one message, or a list of them from flask-web-macos122 with SOCKETIO_COALESCE_MS set
+                latencies.extend(now - item["t"] for item in (data if isinstance(data, list) else [data]))
+                if len(latencies) >= expected:
+                    done.set()
+
+        client.connect(base_url, transports=transports, wait_timeout=10)
+        connections.append(client)
+
+    padding = "x" * payload_bytes if data is None else data
+    per_publisher = [messages // publishers + (1 if i < messages % publishers else 0) for i in range(publishers)]
+
+    # Over long-polling the client batches queued packets into one POST and the server rejects more than 16,
+    # so each publisher keeps a bounded window of unacknowledged messages there
+    window = 8 if connections and connections[0].transport() == "polling" else None
+
+    def publish(client, count):
+        in_flight = threading.BoundedSemaphore(window) if window else None
+        for i in range(count):
+            if in_flight and not in_flight.acquire(timeout=timeout):
+                break
+            client.emit("main_socket", {"seq": i, "t": time.perf_counter(), "data": padding},
+                        callback=(lambda *_: in_flight.release()) if in_flight else None)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=publish, args=(connections[i % clients], n)) for i, n in enumerate(per_publisher)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    publish_s = time.perf_counter() - start
+    done.wait(timeout)
+    elapsed = time.perf_counter() - start
+    closers = [threading.Thread(target=client.disconnect) for client in connections]  # each may wait for a close frame
+    for closer in closers:
+        closer.start()
+    for closer in closers:
+        closer.join()
+    return {
+        "clients": clients,
+        "messages": messages,
+        "publishers": publishers,
+        "payload_bytes": payload_bytes,
+        "transport": connections[0].transport() if connections else None,
+        "publish_rate": round(messages / publish_s, 2),
+        "delivered": len(latencies),
+        "expected": expected,
+        "deliveries_per_s": round(len(latencies) / elapsed, 2),
+        "duration_s": round(elapsed, 3),
+        **latency_summary(latencies),
+    }
+
+
+def start_server(template, env, startup_timeout):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", template, "--port", str(port)],
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    import httpx
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{template} exited with code {process.returncode}")
+        try:
+            if httpx.get(base_url + TEMPLATES[template]["health"], timeout=2).status_code < 500:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{template} did not start within {startup_timeout}s")
+
+
+def run_template(template, args, env):
+    spec = TEMPLATES[template]
+    results = []
+    started = time.perf_counter()
+    process, base_url = start_server(template, env, args.startup_timeout)
+    startup_s = round(time.perf_counter() - started, 2)
+    try:
+        for scenario in spec["scenarios"]:
+            if args.scenarios != "all" and scenario not in args.scenarios.split(","):
+                continue
+            sampler = RssSampler(process.pid)
+            try:
+                if scenario == "health":
+                    result = asyncio.run(drive_http(base_url, "GET", spec["health"], args.requests, args.concurrency))
+                elif scenario == "upload":
+                    images = synthetic_jpegs(min(args.requests, 64))
+                    make = lambda i: [("files", (f"load-{i % len(images)}.jpg", images[i % len(images)], "image/jpeg"))]
+                    result = asyncio.run(drive_http(base_url, "POST", "/uploadimages/", args.requests, args.concurrency, make))
+                elif scenario == "classify":
+                    images = synthetic_jpegs(min(args.requests, 1000), size=(512, 512))
+                    make = lambda i: [("image", (f"load-{i}.jpg", images[i % len(images)], "image/jpeg"))]
+                    result = asyncio.run(drive_http(base_url, "POST", "/process-last-image", args.requests, args.concurrency, make))
+                    result["distinct_images"] = len(images)
+                else:
+                    result = drive_fanout(base_url, args.clients, args.messages, args.publishers, args.payload_bytes)
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            results.append({"template": template, "scenario": scenario, "startup_s": startup_s, **result, **sampler.stop()})
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Add throughput and latency ratios against a previous --output file (> 1 means faster / slower)
+    """
+    with open(baseline_path) as f:
+        baseline = {(r["template"], r.get("scenario")): r for r in json.load(f)["results"]}
+    for result in results:
+        old = baseline.get((result["template"], result.get("scenario")))
+        if not old:
+            continue
+        rate = "rps" if "rps" in result else "deliveries_per_s"
+        ratios = {}
+        if result.get(rate) and old.get(rate):
+            ratios[f"{rate}_ratio"] = round(result[rate] / old[rate], 3)
+        if result.get("p95_ms") and old.get("p95_ms"):
+            ratios["p95_ratio"] = round(result["p95_ms"] / old["p95_ms"], 3)
+        result["vs_baseline"] = ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the server templates on localhost")
+    parser.add_argument("--templates", default="all", help=f"comma separated, from {', '.join(TEMPLATES)}")
+    parser.add_argument("--scenarios", default="all", help="health, upload, classify, fanout")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="per HTTP scenario")
+    parser.add_argument("--clients", type=int, default=20, help="Socket.IO receivers for fanout")
+    parser.add_argument("--messages", type=int, default=200, help="main_socket messages for fanout")
+    parser.add_argument("--publishers", type=int, default=1)
+    parser.add_argument("--payload-bytes", type=int, default=64)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for the servers, e.g. MODEL_NAME=resnet18")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    env = dict(item.split("=", 1) for item in args.env)
+    templates = list(TEMPLATES) if args.templates == "all" else args.templates.split(",")
+    results = []
+    for template in templates:
+        try:
+            results += run_template(template, args, env)
+        except Exception as e:
+            results.append({"template": template, "error": f"{type(e).__name__}: {e}"})
+    if args.baseline:
+        compare(results, args.baseline)
+    report = {
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("serve", "port", "output", "baseline")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
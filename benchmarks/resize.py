@@ -0,0 +1,87 @@
+# Upload resize benchmark: full decode + LANCZOS vs draft/reduce fast mode
+# Usage: python benchmarks/resize.py [--app fastapi-web-macos122] [--repeat 5] [photo.jpg ...]
+
+import argparse
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(template):
+    """
+    Import a template's app.py (it expects to run from its own folder)
+    """
+    template_dir = os.path.join(repo_root, template)
+    os.chdir(template_dir)
+    sys.path.insert(0, template_dir)
+    import app
+    return app
+
+
+def synthetic_photo(width, height):
+    """
+    JPEG with smooth gradients plus fine noise, closer to a phone photo than flat colour
+    """
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40).filter(ImageFilter.GaussianBlur(1))
+    img = Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=92)
+    return buf.getvalue()
+
+
+def psnr(a, b):
+    rms = ImageStat.Stat(ImageChops.difference(a.convert("RGB"), b.convert("RGB"))).rms
+    mse = sum(v * v for v in rms) / len(rms)
+    return float("inf") if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+
+
+def run(app, name, data, repeat, out_dir):
+    results = {}
+    outputs = {}
+    for fast in (False, True):
+        mode = "fast" if fast else "full"
+        out_path = os.path.join(out_dir, f"{mode}.jpg")
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            app.resize_and_save_image(io.BytesIO(data), out_path, fast=fast)
+            times.append(time.perf_counter() - start)
+        outputs[mode] = Image.open(out_path)
+        outputs[mode].load()
+        results[mode] = {
+            "mean_ms": round(1000 * sum(times) / len(times), 2),
+            "images_per_s": round(len(times) / sum(times), 2),
+        }
+    results["fast"]["psnr_vs_full_db"] = round(psnr(outputs["fast"], outputs["full"]), 2)
+    results["speedup"] = round(results["full"]["mean_ms"] / results["fast"]["mean_ms"], 2)
+    return {"image": name, **results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full and fast upload resizing")
+    parser.add_argument("--app", default="fastapi-web-macos122", help="template folder to import resize_and_save_image from")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("images", nargs="*", help="JPEG/PNG files, defaults to synthetic 12 and 48 MP photos")
+    args = parser.parse_args()
+
+    inputs = [(path, open(path, "rb").read()) for path in args.images]
+    if not inputs:
+        inputs = [("synthetic-12mp", synthetic_photo(4000, 3000)), ("synthetic-48mp", synthetic_photo(8000, 6000))]
+
+    app = load_app(args.app)
+    with tempfile.TemporaryDirectory() as out_dir:
+        report = [run(app, name, data, args.repeat, out_dir) for name, data in inputs]
+    print(json.dumps({"target": app.resize_target, "filter": app.resize_filter.name, "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
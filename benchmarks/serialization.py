@@ -0,0 +1,93 @@
+# Socket.IO payload benchmark for flask-web-macos122: JSON text vs binary attachments vs MessagePack
+# Numeric arrays are sent as a list of floats or as packed float32 bytes; reports encode+decode time and bytes on
+# the wire per packet, then the fan-out latency through the real server with each serializer.
+# Usage: python benchmarks/serialization.py [--samples 4096] [--clients 10] [--messages 200] [--micro-only]
+
+import argparse
+import array
+import json
+import math
+import time
+
+import load
+
+VARIANTS = {
+    # name: (server SOCKETIO_SERIALIZER, client serializer, payload as binary)
+    "json": ("json", "default", False),
+    "json-binary": ("json", "default", True),
+    "msgpack": ("msgpack", "msgpack", False),
+    "msgpack-binary": ("msgpack", "msgpack", True),
+}
+
+
+def sample_data(samples, binary):
+    values = [math.sin(i / 16) * 1000 for i in range(samples)]
+    return array.array("f", values).tobytes() if binary else values
+
+
+def packet_classes():
+    from socketio import msgpack_packet, packet
+    return {"default": packet.Packet, "msgpack": msgpack_packet.MsgPackPacket}
+
+
+def roundtrip(packet_class, data):
+    """
+    Encode an exchange event like the server does and decode it like a client, returns the wire size
+    """
+    from socketio import packet
+
+    encoded = packet_class(packet.EVENT, data=["exchange", {"t": 0.0, "data": data}]).encode()
+    parts = encoded if isinstance(encoded, list) else [encoded]  # text packet + binary attachments
+    decoded = packet_class(encoded_packet=parts[0])
+    for attachment in parts[1:]:
+        decoded.add_attachment(attachment)
+    return sum(len(part) for part in parts)
+
+
+def micro(samples, repeat):
+    classes = packet_classes()
+    results = {}
+    for name, (_, client_serializer, binary) in VARIANTS.items():
+        data = sample_data(samples, binary)
+        size = roundtrip(classes[client_serializer], data)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            roundtrip(classes[client_serializer], data)
+        results[name] = {
+            "wire_bytes": size,
+            "roundtrip_us": round((time.perf_counter() - start) / repeat * 1e6, 1),
+        }
+    return results
+
+
+def end_to_end(args):
+    results = {}
+    for name, (server_serializer, client_serializer, binary) in VARIANTS.items():
+        process, base_url = load.start_server("flask-web-macos122", {"SOCKETIO_SERIALIZER": server_serializer, "SOCKETIO_LOG_EVERY": "1000"}, 30)
+        try:
+            result = load.drive_fanout(base_url, args.clients, args.messages, 1, 0, timeout=30,
+                                       data=sample_data(args.samples, binary), serializer=client_serializer)
+        finally:
+            process.terminate()
+            process.wait()
+        results[name] = {key: result[key] for key in ("transport", "delivered", "expected", "deliveries_per_s", "p50_ms", "p95_ms", "p99_ms")}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON, binary and MessagePack Socket.IO payloads")
+    parser.add_argument("--samples", type=int, default=4096, help="floats per message")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--micro-only", action="store_true", help="skip the fan-out through the server")
+    args = parser.parse_args()
+
+    report = {"samples": args.samples, "packet": micro(args.samples, args.repeat)}
+    if not args.micro_only:
+        report["fanout"] = end_to_end(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,34 @@
 # Cross-platform server template for file handling and static file serving
 
 import os
+import io
+import re
+import secrets
+import hashlib
+import stat
+import hmac
+import time
+import threading
 import shutil
+import asyncio
 import platform
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import quote, unquote
+from dataclasses import dataclass, field
 
-from fastapi import FastAPI, UploadFile, HTTPException, File
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, UploadFile as StarletteUploadFile
+from starlette.staticfiles import NotModifiedResponse
 
-from typing import List
 from PIL import Image
 
 import logging
+from metrics import REGISTRY, CONTENT_TYPE, UPLOAD_BYTES, MetricsMiddleware, observe_image_stages
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,
@@ -22,6 +38,23 @@ logging.basicConfig(level=logging.DEBUG,
 image_dir = "images"
 upload_dir = "uploads"
 media_dir = "media" 
+derivative_dir = "derived"
+session_cookie = "session_id"  # API clients can send the same value as an X-Session-Id header
+session_ttl = float(os.environ.get("SESSION_TTL", 6 * 3600))  # idle seconds before a session's images are deleted
+session_max_images = int(os.environ.get("SESSION_MAX_IMAGES", 100))
+session_max_bytes = int(os.environ.get("SESSION_MAX_BYTES", 200 * 1024 * 1024))
+session_max_count = int(os.environ.get("SESSION_MAX_COUNT", 1000))
+session_secret = os.environ.get("SESSION_SECRET", "")  # keys session folder names, generated into session_key_file if unset
+session_key_file = "session.key"
+# name=WxH.format, generated from the resized upload and served immutable under /derived
+image_derivatives = os.environ.get("IMAGE_DERIVATIVES", "thumb=128x128.webp,medium=512x512.webp,medium-avif=512x512.avif")
+resize_target = tuple(int(v) for v in os.environ.get("RESIZE_TARGET", "512x512").split("x"))
+resize_filter = Image.Resampling[os.environ.get("RESIZE_FILTER", "lanczos").upper()]
+resize_quality = int(os.environ.get("RESIZE_QUALITY", 75))  # JPEG/WebP output
+resize_fast = os.environ.get("RESIZE_FAST", "1") == "1"  # JPEG DCT-domain downscale + reduce before the final filter
+upload_max_body_bytes = int(os.environ.get("UPLOAD_MAX_BODY_BYTES", 100 * 1024 * 1024))
+upload_max_request_memory = int(os.environ.get("UPLOAD_MAX_REQUEST_MEMORY", 512 * 1024 * 1024))  # decoded pixels per request
+upload_max_memory = int(os.environ.get("UPLOAD_MAX_MEMORY", 1024 * 1024 * 1024))  # decoded pixels across requests
 
 os_details = {
     "System": platform.system(),
@@ -47,12 +80,325 @@ def setup_root_app_directory():
     if not os.path.exists(upload_dir):
         os.makedirs(upload_dir)
         print(f"Created directory: {upload_dir}")
+    if not os.path.exists(derivative_dir):
+        os.makedirs(derivative_dir)
+        print(f"Created directory: {derivative_dir}")
 
-app = FastAPI(title="FastAPI Web Server")
+def parse_derivative_specs(spec):
+    """
+    "thumb=128x128.webp,..." -> [("thumb", (128, 128), "WEBP", "webp"), ...], skipping formats Pillow can't write
+    """
+    derivatives = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, size_ext = item.partition("=")
+        size, _, ext = size_ext.partition(".")
+        image_format = Image.registered_extensions().get(f".{ext.lower()}")
+        if image_format is None or image_format not in Image.SAVE:
+            logging.warning(f"Skipping derivative {name}: Pillow can't write .{ext}")
+            continue
+        width, height = (int(v) for v in size.split("x"))
+        derivatives.append((name, (width, height), image_format, ext.lower()))
+    return derivatives
+
+
+derivative_specs = parse_derivative_specs(image_derivatives)
+
+_etag_cache = {}
+
+def content_etag(path, stat_result):
+    """
+    Strong ETag from the file content, cached per (path, mtime, size).
+    Hashes the file on a miss, so call it from a worker thread
+    """
+    key = (str(path), stat_result.st_mtime_ns, stat_result.st_size)
+    etag = _etag_cache.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        if len(_etag_cache) > 4096:
+            _etag_cache.clear()
+        _etag_cache[key] = etag
+    return etag
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles with content-hash ETags and a fixed Cache-Control policy
+    """
+    def __init__(self, *args, cache_control="no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def lookup_path(self, path):
+        # StaticFiles.get_response runs this in a worker thread, so the ETag is hashed there
+        # and file_response, called on the event loop, finds it cached
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            content_etag(full_path, stat_result)
+        return full_path, stat_result
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        headers = {"etag": f'"{content_etag(full_path, stat_result)}"', "cache-control": self.cache_control}
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def temp_path(path):
+    """
+    Per-thread name to write path under before os.replace(): two uploads of the
+    same image in parallel threadpool calls write the same derivative path
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def file_info(paths):
+    """
+    Index fields of a stored image: bytes of all its files, mtime and sha256 of the image itself
+    """
+    digest = hashlib.sha256()
+    with open(paths[0], "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return {
+        "bytes": sum(os.path.getsize(path) for path in paths if os.path.exists(path)),
+        "mtime": os.path.getmtime(paths[0]),
+        "sha256": digest.hexdigest(),
+    }
+
+
+@dataclass
+class Session:
+    id: str
+    last_seen: float
+    images: "OrderedDict[str, dict]" = field(default_factory=OrderedDict)  # name -> url, derivatives, paths, bytes, mtime, sha256
+    bytes: int = 0
+
+
+def load_session_secret(path):
+    """
+    SESSION_SECRET, or a random one kept in path so session folders survive a restart
+    """
+    if session_secret:
+        return session_secret.encode()
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        secret = secrets.token_bytes(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+
+
+class SessionStore:
+    """
+    Per-session image folders (images/<key>/, derived/<key>/, ...) with an
+    in-memory index, per-session quotas and idle expiry.
+    Folders and the index use an HMAC of the session ID as the key, so image URLs
+    never reveal the ID, which is the only credential of a session.
+    Going over a quota evicts the session's oldest images. The index is only touched
+    on the event loop, files are deleted in the thread pool.
+    """
+    def __init__(self, roots, secret, ttl, max_images, max_bytes, max_sessions):
+        self.roots = roots  # image_dir first
+        self.secret = secret
+        self.ttl = ttl
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()  # least recently seen first
+        self.evicted_images = 0
+        self.expired_sessions = 0
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(18)
+
+    @staticmethod
+    def valid_id(session_id):
+        return bool(session_id) and re.fullmatch(r"[A-Za-z0-9_-]{16,64}", session_id) is not None
+
+    @staticmethod
+    def valid_key(key):
+        return re.fullmatch(r"[0-9a-f]{32}", key) is not None
+
+    def key(self, session_id):
+        """Public folder name of a session"""
+        return hmac.new(self.secret, session_id.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def folder(self, session_id, root=None):
+        return os.path.join(root or self.roots[0], self.key(session_id))
+
+    def make_folders(self, session_id):
+        for root in self.roots:
+            os.makedirs(self.folder(session_id, root), exist_ok=True)
+
+    def touch(self, session_id, create=True):
+        key = self.key(session_id)
+        session = self.sessions.get(key)
+        if session is None:
+            if not create:
+                return None
+            session = self.sessions[key] = Session(key, time.time())
+        session.last_seen = time.time()
+        self.sessions.move_to_end(key)
+        return session
+
+    def image_urls(self, session_id):
+        session = self.sessions.get(self.key(session_id))
+        return [image["url"] for image in session.images.values()] if session else []
+
+    def add(self, session_id, name, url, derivatives, paths, info=None):
+        """
+        Index a stored image (info from file_info(), read from disk if not given),
+        returns the paths that are no longer referenced
+        """
+        session = self.touch(session_id)
+        garbage = []
+        old = session.images.pop(name, None)
+        if old:
+            session.bytes -= old["bytes"]
+            garbage += [path for path in old["paths"] if path not in paths]
+        info = info or file_info(paths)
+        session.images[name] = {"url": url, "derivatives": derivatives, "paths": paths, **info}
+        session.bytes += info["bytes"]
+        while len(session.images) > 1 and (len(session.images) > self.max_images or session.bytes > self.max_bytes):
+            _, evicted = session.images.popitem(last=False)
+            session.bytes -= evicted["bytes"]
+            garbage += evicted["paths"]
+            self.evicted_images += 1
+        return garbage
+
+    def latest(self, session_id):
+        """Name of the session's newest image or None, O(1) since images are kept in upload order"""
+        session = self.sessions.get(self.key(session_id))
+        return next(reversed(session.images), None) if session else None
+
+    def image(self, session_id, name):
+        session = self.sessions.get(self.key(session_id))
+        return session.images.get(name) if session else None
+
+    def listing(self, session_id):
+        """The session's images, oldest first, without touching the disk"""
+        session = self.sessions.get(self.key(session_id))
+        if session is None:
+            return []
+        return [
+            {"name": name, "url": image["url"], "bytes": image["bytes"], "mtime": image["mtime"], "sha256": image["sha256"], "derivatives": image["derivatives"]}
+            for name, image in session.images.items()
+        ]
+
+    def clear(self, session_id):
+        """Forget a session, returns its folders"""
+        return self._clear(self.key(session_id))
+
+    def _clear(self, key):
+        self.sessions.pop(key, None)
+        return [os.path.join(root, key) for root in self.roots]
+
+    def expire(self):
+        """Forget sessions idle for longer than ttl (or over max_sessions), returns their folders"""
+        now = time.time()
+        folders = []
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if now - session.last_seen <= self.ttl and len(self.sessions) <= self.max_sessions:
+                break
+            folders += self._clear(key)
+            self.expired_sessions += 1
+        return folders
+
+    def rebuild(self):
+        """
+        Index the session folders already on disk, so sessions survive a restart
+        """
+        if not os.path.isdir(self.roots[0]):
+            return
+        for key in os.listdir(self.roots[0]):
+            folder = os.path.join(self.roots[0], key)
+            if not self.valid_key(key) or not os.path.isdir(folder):
+                continue
+            names = sorted(os.listdir(folder), key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+            related = {root: os.listdir(os.path.join(root, key)) for root in self.roots[1:] if os.path.isdir(os.path.join(root, key))}
+            session = Session(key, os.path.getmtime(folder))
+            for name in names:
+                derivatives = {}
+                paths = [os.path.join(folder, name)]
+                for root, files in related.items():
+                    for filename in files:
+                        match = re.fullmatch(re.escape(name) + r"\.[0-9a-f]{16}\.([^.]+)\.[^.]+", filename)
+                        if match:
+                            derivatives[match.group(1)] = path_url(os.path.join(root, key, filename))
+                        elif not (filename.startswith(name + ".") and "." not in filename[len(name) + 1:]):
+                            continue
+                        paths.append(os.path.join(root, key, filename))
+                info = file_info(paths)
+                session.images[name] = {"url": path_url(os.path.join(folder, name)), "derivatives": derivatives, "paths": paths, **info}
+                session.bytes += info["bytes"]
+                session.last_seen = max(session.last_seen, info["mtime"])
+            self.sessions[key] = session
+        for key in sorted(self.sessions, key=lambda k: self.sessions[k].last_seen):
+            self.sessions.move_to_end(key)
+        logging.info(f"Indexed {len(self.sessions)} sessions from disk")
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "images": sum(len(s.images) for s in self.sessions.values()),
+            "bytes": sum(s.bytes for s in self.sessions.values()),
+            "evicted_images": self.evicted_images,
+            "expired_sessions": self.expired_sessions,
+        }
+
+
+def remove_paths(paths):
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f'Failed to delete {path}. Reason: {e}')
+
+
+async def evict_idle_sessions():
+    """
+    Background task: delete the folders of sessions idle for longer than session_ttl
+    """
+    while True:
+        await asyncio.sleep(max(1.0, min(60.0, session_ttl / 4)))
+        folders = sessions.expire()
+        if folders:
+            await run_in_threadpool(remove_paths, folders)
+
+
+sessions = SessionStore([image_dir, derivative_dir], load_session_secret(session_key_file), session_ttl, session_max_images, session_max_bytes, session_max_count)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(sessions.rebuild)
+    eviction = asyncio.create_task(evict_idle_sessions())
+    yield
+    eviction.cancel()
+
+
+app = FastAPI(title="FastAPI Web Server", lifespan=lifespan)
 setup_root_app_directory()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/images", StaticFiles(directory="images"), name="images")
+# Upload names can be reused, so /images revalidates; derivatives have content-hashed names and never change
+app.mount("/images", CachedStaticFiles(directory=image_dir, cache_control="no-cache"), name="images")
+app.mount("/derived", CachedStaticFiles(directory=derivative_dir, cache_control="public, max-age=31536000, immutable"), name="derived")
 
 origins = [
     "http://localhost",
@@ -68,59 +414,157 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def resize_and_save_image(input_path, output_path):
+
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
     """
-    Resize an image to 512x512 pixels and save it to the specified output path.
+    Give every client a session ID (cookie) so uploads are kept per session.
+    The cookie is re-issued whenever a request uses the session, so it expires
+    session_ttl after the last use, like the session's files.
     """
-    with Image.open(input_path) as img:
+    session_id = request.cookies.get(session_cookie) or request.headers.get("x-session-id")
+    is_new = not SessionStore.valid_id(session_id)
+    if is_new:
+        session_id = SessionStore.new_id()
+    request.state.session_id = session_id
+    started = time.time()
+    response = await call_next(request)
+    session = sessions.sessions.get(sessions.key(session_id))
+    if is_new or (session is not None and session.last_seen >= started):
+        response.set_cookie(session_cookie, session_id, max_age=int(session_ttl), httponly=True, samesite="lax")
+    return response
+
+# Added last so it is outermost and its latencies include the other middleware
+app.add_middleware(MetricsMiddleware)
+
+def resize_and_save_image(source, output_path, fast=None):
+    """
+    Resize an image to resize_target (512x512) and save it to the specified output path.
+    source is a path or a file object (e.g. the spooled upload buffer), returns stage timings in ms.
+    In fast mode JPEGs are decoded at a reduced DCT scale and large images are reduced
+    with a cheap box filter down to 2x the target before the final filter runs.
+    """
+    fast = resize_fast if fast is None else fast
+    reducing_gap = 2.0 if fast else None
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(source) as img:
+        if fast:
+            img.draft('RGB', (int(resize_target[0] * reducing_gap), int(resize_target[1] * reducing_gap)))  # JPEG only
+        img.load()
+        timings["decode_ms"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
         if img.mode != 'RGB':
             img = img.convert('RGB')
-        resized_img = img.resize((512, 512), Image.Resampling.LANCZOS)
-        resized_img.save(output_path)
-    os.remove(input_path)  # Remove the temporary file
-
-def print_folder_contents(folder_path):
-    """
-    To inspect server directory on button click
-    """
-    if os.path.exists(folder_path):
-        print(f"Contents of {folder_path}:")
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            print(f" - {file_path}")
-    else:
-        print(f"Folder {folder_path} does not exist.")
-
-def clear_uploaded_images():
-    """
-    Clear on client login for simplicity
-    """
-    global file_urls
-    file_urls = []
-    global upload_data
-    upload_data = []
-    global image_dir
-    if os.path.exists(image_dir):
-        for filename in os.listdir(image_dir):
-            file_path = os.path.join(image_dir, filename)
-            print(f"Attempting to delete: {file_path}")
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                    print(f"Deleted: {file_path}")
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                    print(f"Deleted directory: {file_path}")
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}')
+        resized_img = img.resize(resize_target, resize_filter, reducing_gap=reducing_gap)
+        timings["resize_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    encoded = io.BytesIO()
+    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower(), "PNG")
+    options = {"quality": resize_quality} if image_format in ("JPEG", "WEBP") else {}
+    resized_img.save(encoded, format=image_format, **options)
+    timings["encode_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    with open(output_path, "wb") as f:
+        f.write(encoded.getbuffer())
+    timings["write_ms"] = (time.perf_counter() - start) * 1000
+    return timings
+
+
+
+def generate_derivatives(image_path, out_dir):
+    """
+    Write the configured derivatives of a stored image into out_dir, returns {name: url}.
+    File names carry a hash of their content, so a URL always means the same bytes.
+    """
+    stem = os.path.basename(image_path)
+    urls = {}
+    with Image.open(image_path) as img:
+        img.load()
+        for name, size, image_format, ext in derivative_specs:
+            encoded = io.BytesIO()
+            resized = img if img.size == size else img.resize(size, resize_filter, reducing_gap=2.0)
+            options = {"quality": resize_quality} if image_format in ("JPEG", "WEBP", "AVIF") else {}
+            resized.save(encoded, format=image_format, **options)
+            digest = hashlib.sha256(encoded.getbuffer()).hexdigest()[:16]
+            filename = f"{stem}.{digest}.{name}.{ext}"
+            path = os.path.join(out_dir, filename)
+            if not os.path.exists(path):
+                tmp = temp_path(path)
+                with open(tmp, "wb") as f:
+                    f.write(encoded.getbuffer())
+                os.replace(tmp, path)
+            urls[name] = path_url(path)
+    return urls
+
+
+def path_url(path):
+    """URL of a file under a mounted folder, percent-encoded since upload names may contain # ? or %"""
+    return "/" + quote(path)
+
+
+
+def estimate_decode_bytes(source):
+    """
+    Peak memory needed to decode and resize an image, read from its header only
+    """
+    with Image.open(source) as img:
+        if resize_fast:
+            img.draft('RGB', (resize_target[0] * 2, resize_target[1] * 2))  # only changes the reported size
+        pixels = img.width * img.height
+        bands = len(img.getbands())
+        convert = pixels * 3 if img.mode != 'RGB' else 0
+    source.seek(0)
+    return pixels * bands + convert + resize_target[0] * resize_target[1] * 3
+
+
+
+class MemoryBudget:
+    """
+    Async byte budget shared by concurrent decodes, acquire waits until enough is released
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        if n > self.limit:
+            raise HTTPException(status_code=413, detail=f"Image needs {n} bytes to decode, limit is {self.limit}")
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n):
+        async with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+upload_memory = MemoryBudget(upload_max_memory)
+
+async def clear_uploaded_images(session_id):
+    """
+    Delete the images of one session, other sessions are left alone
+    """
+    await run_in_threadpool(remove_paths, sessions.clear(session_id))
+
+def print_session_images(session_id):
+    """
+    Print a session's images from the index, without listing its folder
+    """
+    print(f"Contents of {sessions.folder(session_id)}:")
+    for image in sessions.listing(session_id):
+        print(f" - {image['url'].lstrip('/')} ({image['bytes']} bytes)")
 
 @app.get("/")
-def read_root():
-    global image_dir
-    clear_uploaded_images()
-    print_folder_contents(image_dir)
+def read_root(request: Request):
+    session_id = request.state.session_id
+    sessions.touch(session_id, create=False)  # a reload keeps the session's uploads
+    print_session_images(session_id)
     return FileResponse("static/index.html")
 
+
 @app.post("/uploads/")
 def create_upload_file(file: UploadFile = UploadFile(...)):
     return {"filename": file.filename}
@@ -129,25 +573,100 @@ def create_upload_file(file: UploadFile = UploadFile(...)):
 def create_upload_file(file: UploadFile = UploadFile(...)):
     return {"filename": file.filename}
 
+async def _store_upload(file, request_memory, session_id):
+    """
+    Decode the upload straight from its spooled buffer, within the request and global memory caps
+    """
+    file_location = f"{sessions.folder(session_id)}/{os.path.basename(file.filename)}"
+    needed = await run_in_threadpool(estimate_decode_bytes, file.file)
+    start = time.perf_counter()
+    await request_memory.acquire(needed)
+    try:
+        await upload_memory.acquire(needed)
+    except BaseException:
+        await request_memory.release(needed)
+        raise
+    wait_ms = (time.perf_counter() - start) * 1000
+    try:
+        timings = await run_in_threadpool(resize_and_save_image, file.file, file_location)
+        observe_image_stages(timings)
+    finally:
+        await upload_memory.release(needed)
+        await request_memory.release(needed)
+    start = time.perf_counter()
+    derivatives = await run_in_threadpool(generate_derivatives, file_location, sessions.folder(session_id, derivative_dir))
+    timings["derivatives_ms"] = (time.perf_counter() - start) * 1000
+    paths = [file_location] + [unquote(url).lstrip("/") for url in derivatives.values()]
+    info = await run_in_threadpool(file_info, paths)  # sizes and hash for the index, off the event loop
+    return {"filename": file.filename, "memory_wait_ms": wait_ms, **timings, "derivatives": derivatives, "paths": paths, "info": info}
+
+
+
 @app.post("/uploadimages/")
-async def upload_images(files: List[UploadFile] = File(...)):
-    global upload_data
-    global file_urls
-    for file in files:
-        if file.content_type not in ["image/jpg", "image/jpeg", "image/png"]:
-            raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
-
-        file_location = f"{image_dir}/{file.filename}"
-        temp_file_path = file_location + ".tmp"
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        resize_and_save_image(temp_file_path, file_location)
-        file_url = f"/{image_dir}/{file.filename}"
-        file_urls.append(file_url)
-        await file.close()
-
-    return JSONResponse(content={"upload callback": "Files uploaded successfully", "image_urls": file_urls})
+async def upload_images(request: Request):
+    session_id = request.state.session_id
+    content_length = int(request.headers.get("content-length", 0))
+    if content_length > upload_max_body_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload of {content_length} bytes exceeds {upload_max_body_bytes}")
+
+    start = time.perf_counter()
+    async with request.form() as form:
+        receive_ms = (time.perf_counter() - start) * 1000
+        files = [f for f in form.getlist("files") if isinstance(f, StarletteUploadFile)]
+        UPLOAD_BYTES.inc(sum(file.size or 0 for file in files))
+        if not files:
+            raise HTTPException(status_code=400, detail="No files uploaded")
+        for file in files:
+            if file.content_type not in ["image/jpg", "image/jpeg", "image/png"]:
+                raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
+        if len(files) > session_max_images:
+            raise HTTPException(status_code=413, detail=f"At most {session_max_images} images per session")
+
+        # Files of one request are decoded concurrently, bounded by the memory caps
+        request_memory = MemoryBudget(upload_max_request_memory)
+        sessions.touch(session_id)
+        await run_in_threadpool(sessions.make_folders, session_id)
+        try:
+            timings = await asyncio.gather(*(_store_upload(file, request_memory, session_id) for file in files))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to process the upload: {str(e)}")
+
+    derivatives = {}
+    garbage = []
+    for file, stage_timings in zip(files, timings):
+        stage_timings["receive_ms"] = receive_ms
+        name = os.path.basename(file.filename)
+        file_url = path_url(os.path.join(sessions.folder(session_id), name))
+        derivatives[file_url] = stage_timings.pop("derivatives")
+        garbage += sessions.add(session_id, name, file_url, derivatives[file_url], stage_timings.pop("paths"), stage_timings.pop("info"))
+    await run_in_threadpool(remove_paths, garbage)  # replaced derivatives and images over the session quota
+
+    return JSONResponse(content={"upload callback": "Files uploaded successfully", "image_urls": sessions.image_urls(session_id), "derivatives": derivatives, "timings": timings})
+
+
+@app.get("/images")
+def list_images(request: Request):
+    """The caller's uploaded images, newest last, from the in-memory index"""
+    session_id = request.state.session_id
+    return {"images": sessions.listing(session_id), "latest": sessions.latest(session_id)}
+
+@app.delete("/images")
+async def delete_images(request: Request):
+    """Delete the caller's uploaded images"""
+    await clear_uploaded_images(request.state.session_id)
+    return {"status": "cleared"}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text format: per-route request counts and latency, upload and image stage timings"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.get("/sessions/stats")
+def session_stats():
+    """Sessions, stored images and quota evictions"""
+    return sessions.stats()
 
 @app.get("/health")
 def health_check():
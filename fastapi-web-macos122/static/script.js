@@ -21,7 +21,10 @@ document.getElementById('uploadform').addEventListener('submit', async function(
                 const img = document.createElement('img');
                 img.style.height = '100%';
                 img.style.maxWidth = '100%';
-                img.src = url;
+                // Prefer the small, long-cached derivative over the original upload
+                const derived = data.derivatives && data.derivatives[url];
+                img.src = (derived && derived.medium) || url;
+                img.dataset.imageId = decodeURIComponent(url.split('/').pop()); // URLs come percent-encoded
                 img.id = 'uploadedImage';
                 placeholder.appendChild(img);
             });
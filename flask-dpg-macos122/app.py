@@ -3,11 +3,16 @@
 
 import logging
 import os
+import queue
 import signal
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, jsonify
 from werkzeug.exceptions import HTTPException
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+from metrics import instrument_flask
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -17,11 +22,105 @@ logger = logging.getLogger(__name__)
 # Flask app
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+instrument_flask(app)  # per-route request metrics and GET /metrics
+
+# Web server backend: pool (default, a fixed thread pool over Werkzeug), waitress, cheroot, werkzeug (the
+# single-threaded dev server) or gunicorn (headless only, it needs the main thread that DearPyGUI uses)
+WSGI_SERVER = os.environ.get('WSGI_SERVER', 'pool')
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+WSGI_WORKERS = int(os.environ.get('WSGI_WORKERS', 2))  # gunicorn processes
+WSGI_KEEPALIVE = float(os.environ.get('WSGI_KEEPALIVE', 5))  # seconds an idle connection stays open (read timeout for pool)
+HEADLESS = os.environ.get('HEADLESS', '0') == '1'
+# GUI frame rate: GUI_ACTIVE_FPS while state changes or input keep coming and for GUI_ACTIVE_SECONDS after,
+# GUI_IDLE_FPS otherwise (a state change from a Flask handler wakes the loop at once)
+GUI_IDLE_FPS = float(os.environ.get('GUI_IDLE_FPS', 5))
+GUI_ACTIVE_FPS = float(os.environ.get('GUI_ACTIVE_FPS', 60))
+GUI_ACTIVE_SECONDS = float(os.environ.get('GUI_ACTIVE_SECONDS', 1))
 
 # Global variables for GUI communication
 server_status = "running"
 gui_ready = False
 dpg_context = None
+gui_items = {}  # item ids the render loop updates
+gui_events = queue.Queue()  # (kind, data) from any thread to the GUI main thread
+render_scheduler = None
+server_address = (os.environ.get('HOST', '0.0.0.0'), int(os.environ.get('PORT', 5000)))  # where the web server listens
+shutdown_requested = threading.Event()  # set by signal_handler, polled by the render loop
+shutdown_signal = None
+
+def notify_gui(kind, **data):
+    """
+    Queue a state change for the GUI and wake its render loop, safe from any thread
+    """
+    gui_events.put((kind, data))
+
+def set_server_status(status):
+    global server_status
+    server_status = status
+    notify_gui('status', status=status)
+
+class RenderScheduler:
+    """
+    Adaptive frame pacing for the DearPyGUI loop: active_fps while events or input arrive and for active_seconds
+    after, idle_fps otherwise. Between frames it waits on the event queue, so an event renders without delay.
+    """
+    def __init__(self, render, handle_event, events, idle_fps, active_fps, active_seconds):
+        self.render = render
+        self.handle_event = handle_event
+        self.events = events
+        self.idle_fps = idle_fps
+        self.active_fps = active_fps
+        self.active_seconds = active_seconds
+        self.last_activity = time.monotonic()  # start active so the first frames draw promptly
+        self.frames = 0
+        self.events_handled = 0
+        self.mode = 'active'
+        self.fps = None
+        self.cpu_percent = None
+        self._sample = (time.monotonic(), time.process_time(), 0)
+
+    def activity(self):
+        self.last_activity = time.monotonic()
+
+    def run_once(self):
+        """
+        Render one frame, then handle events until the next frame is due
+        """
+        frame_start = time.monotonic()
+        self.render()
+        self.frames += 1
+        active = frame_start - self.last_activity < self.active_seconds
+        self.mode = 'active' if active else 'idle'
+        # Never faster than active_fps, even when events keep arriving
+        time.sleep(max(0.0, frame_start + 1 / self.active_fps - time.monotonic()))
+        deadline = frame_start + 1 / (self.active_fps if active else self.idle_fps)
+        try:
+            event = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+            while True:
+                self.handle_event(*event)
+                self.events_handled += 1
+                self.activity()
+                event = self.events.get_nowait()
+        except queue.Empty:
+            pass
+        self._measure()
+
+    def _measure(self):
+        wall, cpu, frames = self._sample
+        now = time.monotonic()
+        if now - wall >= 1:
+            self.cpu_percent = round((time.process_time() - cpu) / (now - wall) * 100, 1)
+            self.fps = round((self.frames - frames) / (now - wall), 1)
+            self._sample = (now, time.process_time(), self.frames)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'frames': self.frames,
+            'events': self.events_handled,
+            'fps': self.fps,
+            'process_cpu_percent': self.cpu_percent,
+        }
 
 # Security headers
 @app.after_request
@@ -74,20 +173,19 @@ def server_status_endpoint():
         'web_server': 'running',
         'gui_app': server_status,
         'gui_ready': gui_ready,
+        'gui_loop': render_scheduler.stats() if render_scheduler else None,
         'timestamp': time.time()
     })
 
 # GUI control endpoints
 @app.route('/gui/start', methods=['POST'])
 def start_gui():
-    global server_status
-    server_status = "running"
+    set_server_status("running")
     return jsonify({'status': 'success', 'message': 'GUI is running'})
 
 @app.route('/gui/stop', methods=['POST'])
 def stop_gui():
-    global server_status
-    server_status = "stopping"
+    set_server_status("stopping")
     return jsonify({'status': 'success', 'message': 'GUI stopping'})
 
 def create_gui():
@@ -131,13 +229,18 @@ def create_gui():
             dpg.add_text("Server Log:")
             log_text = dpg.add_text("", wrap=700)
             
-            # Update log periodically
+            # Update log on the first frame, then on every event from the web side
             def update_log():
                 if dpg.does_item_exist(log_text):
-                    dpg.set_value(log_text, f"Last update: {time.strftime('%H:%M:%S')} - Server running on port 5000")
+                    dpg.set_value(log_text, f"Last update: {time.strftime('%H:%M:%S')} - Server running on port {server_address[1]}")
             
-            # Set up periodic updates using a timer
             dpg.set_frame_callback(frame=0, callback=update_log)
+            gui_items.update(status=status_text, log=log_text)
+        
+        # Mouse and keyboard input keep the render loop at the active frame rate
+        with dpg.handler_registry():
+            for add_handler in (dpg.add_mouse_move_handler, dpg.add_mouse_click_handler, dpg.add_mouse_wheel_handler, dpg.add_key_press_handler):
+                add_handler(callback=lambda *args: render_scheduler and render_scheduler.activity())
         
         gui_ready = True
         dpg.setup_dearpygui()
@@ -168,40 +271,160 @@ def update_gui_status(sender, app_data, user_data):
         else:
             dpg_context.configure_item(user_data, color=(255, 255, 0))  # Yellow
 
+def apply_gui_event(kind, data):
+    """
+    Show a queued state change in the GUI, runs on the main thread between frames
+    """
+    if kind == 'status' and 'status' in gui_items:
+        update_gui_status(None, None, gui_items['status'])
+    if 'log' in gui_items and dpg_context.does_item_exist(gui_items['log']):
+        dpg_context.set_value(gui_items['log'], f"Last update: {time.strftime('%H:%M:%S')} - {kind} {data}")
+
 def open_web_interface():
     """Open web interface in default browser"""
     import webbrowser
-    webbrowser.open('http://localhost:5000')
+    host, port = server_address
+    webbrowser.open(f"http://{'localhost' if host in ('0.0.0.0', '::', '') else host}:{port}")
 
 def show_server_info():
     """Show server information in GUI"""
     if dpg_context:
+        host, port = server_address
         with dpg_context.window(label="Server Information", width=400, height=300):
             dpg_context.add_text(f"Flask Version: {Flask.__version__}")
             dpg_context.add_text(f"Python Version: {sys.version}")
-            dpg_context.add_text(f"Server Port: 5000")
-            dpg_context.add_text(f"Host: 0.0.0.0")
+            dpg_context.add_text(f"Server Port: {port}")
+            dpg_context.add_text(f"Host: {host}")
+            dpg_context.add_text(f"WSGI Server: {WSGI_SERVER} ({WSGI_THREADS} threads)")
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's server with connections handled by a fixed pool of threads instead of one at a time.
+    Werkzeug closes every connection after one response (no keep-alive), keepalive is only the read
+    timeout that stops a silent client from holding a pool thread.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads, keepalive):
+        handler = type('TimeoutRequestHandler', (WSGIRequestHandler,), {'timeout': keepalive})
+        super().__init__(host, port, app, handler=handler)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
 
-def run_integrated_server():
+class WaitressServer:
+    def __init__(self, host, port, app, threads, keepalive):
+        import waitress
+        self.server = waitress.create_server(app, host=host, port=port, threads=threads, channel_timeout=keepalive)
+
+    def serve_forever(self):
+        self.server.run()
+
+    def shutdown(self):
+        self.server.close()
+
+class CherootServer:
+    def __init__(self, host, port, app, threads, keepalive):
+        from cheroot import wsgi
+        self.server = wsgi.Server((host, port), app, numthreads=threads, timeout=int(keepalive))
+
+    def serve_forever(self):
+        self.server.start()
+
+    def shutdown(self):
+        self.server.stop()
+
+WSGI_SERVERS = {
+    'pool': PooledWSGIServer,
+    'waitress': WaitressServer,
+    'cheroot': CherootServer,
+    'werkzeug': lambda host, port, app, threads, keepalive: make_server(host, port, app),
+}
+
+def make_wsgi_server(host, port):
+    """
+    WSGI server for the configured backend with serve_forever() and shutdown(), safe to run in a background thread
+    """
+    backend = WSGI_SERVER
+    if backend == 'gunicorn':
+        logger.warning("gunicorn needs the main thread, using the pool server next to the GUI")
+        backend = 'pool'
+    if backend not in WSGI_SERVERS:
+        raise ValueError(f"Unknown WSGI_SERVER {backend}, expected one of {', '.join(list(WSGI_SERVERS) + ['gunicorn'])}")
+    settings = {
+        'pool': f"{WSGI_THREADS} threads, {WSGI_KEEPALIVE}s read timeout, no keep-alive",
+        'waitress': f"{WSGI_THREADS} threads, keep-alive {WSGI_KEEPALIVE}s",
+        'cheroot': f"{WSGI_THREADS} threads, keep-alive {int(WSGI_KEEPALIVE)}s",
+        'werkzeug': "one request at a time, no keep-alive",
+    }
+    logger.info(f"Web server: {backend} with {settings[backend]}")
+    return WSGI_SERVERS[backend](host, port, app, WSGI_THREADS, WSGI_KEEPALIVE)
+
+def run_gunicorn(host, port):
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', str(WSGI_WORKERS))
+            self.cfg.set('threads', str(WSGI_THREADS))
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('keepalive', str(int(WSGI_KEEPALIVE)))
+
+        def load(self):
+            return app
+
+    logger.info(f"Web server: gunicorn with {WSGI_WORKERS} workers x {WSGI_THREADS} threads, keep-alive {WSGI_KEEPALIVE}s")
+    GunicornApplication().run()
+
+def run_headless(host, port):
+    """Run only the web server, in the main thread"""
+    global server_address
+    server_address = (host, port)
+    logger.info(f"Starting Flask server on {host}:{port} without the GUI")
+    if WSGI_SERVER == 'gunicorn':
+        run_gunicorn(host, port)
+    else:
+        make_wsgi_server(host, port).serve_forever()
+
+def run_integrated_server(host='0.0.0.0', port=5000):
     """Run Flask and DearPyGUI together"""
-    global dpg_context, server_status, http_server
+    global dpg_context, server_status, gui_ready, http_server, render_scheduler, server_address
+    server_address = (host, port)
     
+    if HEADLESS:
+        run_headless(host, port)
+        return True
+
     # Create GUI
     dpg_context = create_gui()
     if not dpg_context:
         logger.error("Failed to create GUI, running Flask only")
-        return False
+        run_headless(host, port)
+        return True
     
     # Start Flask in a way that works with DearPyGUI
-    from werkzeug.serving import make_server
     from threading import Thread
     
-    # Create WSGI server
-    http_server = make_server('0.0.0.0', 5000, app)
+    # Create WSGI server, it serves from a background thread so the GUI keeps the main thread
+    http_server = make_wsgi_server(host, port)
     
     # Start Flask server in background thread
     def run_flask():
-        logger.info("Starting Flask server on 0.0.0.0:5000")
+        logger.info(f"Starting Flask server on {host}:{port}")
         http_server.serve_forever()
     
     flask_thread = Thread(target=run_flask, daemon=True)
@@ -210,10 +433,17 @@ def run_integrated_server():
     # Main GUI loop with Flask integration
     logger.info("Starting integrated Flask + DearPyGUI server")
     
+    render_scheduler = RenderScheduler(dpg_context.render_dearpygui_frame, apply_gui_event, gui_events,
+                                       GUI_IDLE_FPS, GUI_ACTIVE_FPS, GUI_ACTIVE_SECONDS)
     try:
         while dpg_context.is_dearpygui_running() and server_status != "stopping":
-            dpg_context.render_dearpygui_frame()
-            time.sleep(0.01)
+            render_scheduler.run_once()
+            
+            # A signal only sets the flag, the shutdown itself happens here
+            if shutdown_requested.is_set():
+                logger.info(f"Received signal {shutdown_signal}, shutting down gracefully")
+                set_server_status("stopping")
+                break
             
             # Check if Flask server is still running
             if not flask_thread.is_alive():
@@ -238,11 +468,15 @@ def run_integrated_server():
 
 # Graceful shutdown handler
 def signal_handler(sig, frame):
-    logger.info(f"Received signal {sig}, shutting down gracefully")
-    global server_status
-    server_status = "stopping"
-    time.sleep(1)
-    sys.exit(0)
+    """
+    Only record the request: logging or queueing here could deadlock on a lock the interrupted
+    code holds. The GUI loop polls shutdown_requested; without it (headless) exit right away.
+    """
+    global shutdown_signal
+    shutdown_signal = sig
+    shutdown_requested.set()
+    if render_scheduler is None:
+        sys.exit(0)
 
 # Register signal handlers
 signal.signal(signal.SIGINT, signal_handler)
@@ -256,7 +490,7 @@ if __name__ == "__main__":
     logger.info("Press Ctrl+C to stop the server gracefully")
     
     try:
-        success = run_integrated_server()
+        success = run_integrated_server(host, port)
         if not success:
             logger.error("Failed to start Flask + DearPyGUI server")
             sys.exit(1)
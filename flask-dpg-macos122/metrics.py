@@ -0,0 +1,292 @@
+# Prometheus-style metrics without dependencies, shared by the Flask and FastAPI templates
+# (each template keeps an identical copy so it still deploys on its own)
+
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    One metric family, children are keyed by their label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """
+        Child for these label values (positional, in labelnames order), created on first use
+        """
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines += self._render_child(values, child)
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def get(self):
+        return self._children[()].value
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set(self, value):
+        self._children[()].set(value)
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        """
+        Per-bucket (not cumulative) counts, count and sum, for the JSON stats endpoints
+        """
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        labels = [_number(b) for b in self.bounds] + ["+Inf"]
+        return {"buckets": dict(zip(labels, counts)), "count": sum(counts), "sum": round(total, 6)}
+
+
+class _Timer:
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    """
+    Cumulative buckets in the Prometheus format, values in seconds unless the name says otherwise
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.bounds = sorted(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.bounds)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def snapshot(self):
+        return self._children[()].snapshot()
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + [float("inf")], child.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, [('le', _number(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {_number(child.sum)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        # Re-registering returns the existing metric, so reloading an app module doesn't fail
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def render(self):
+        """
+        Text exposition format for GET /metrics
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Standard metrics, templates only update the ones that apply to them
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+HTTP_LATENCY = REGISTRY.histogram("http_request_duration_seconds", "HTTP request latency by route template", ("method", "route"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "HTTP requests being served")
+UPLOAD_BYTES = REGISTRY.counter("upload_bytes_total", "Bytes received by upload endpoints")
+IMAGE_STAGE = REGISTRY.histogram("image_stage_seconds", "Upload image processing time by stage (decode, resize, encode, write)", ("stage",))
+INFERENCE = REGISTRY.histogram("model_inference_seconds", "Forward pass time per batch", ("model",))
+SOCKETIO_MESSAGES = REGISTRY.counter("socketio_messages_total", "Socket.IO messages by event and direction (in, out, dropped)", ("event", "direction"))
+SOCKETIO_CLIENTS = REGISTRY.gauge("socketio_clients", "Connected Socket.IO clients")
+SOCKETIO_QUEUE_DEPTH = REGISTRY.histogram("socketio_send_queue_depth", "Outbound messages queued for a client, observed on every send", buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+SOCKETIO_QUEUE_DROPPED = REGISTRY.counter("socketio_send_queue_dropped_total", "Outbound messages dropped by a full per-client queue, by overflow policy", ("policy",))
+
+
+def observe_image_stages(timings):
+    """
+    Record the *_ms stage timings returned by resize_and_save_image
+    """
+    for stage in ("decode", "resize", "encode", "write"):
+        if f"{stage}_ms" in timings:
+            IMAGE_STAGE.labels(stage).observe(timings[f"{stage}_ms"] / 1000)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware for the FastAPI templates: request count, latency and in-flight requests per route.
+    Routes are labelled by their template (/classify/{image_id}), mounts by their prefix.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            label = getattr(route, "path", None) or (f"{scope['root_path']}/*" if scope.get("root_path") else "<unmatched>")
+            HTTP_LATENCY.labels(scope["method"], label).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(scope["method"], label, status[0]).inc()
+
+
+def instrument_flask(app, path="/metrics"):
+    """
+    Request count, latency and in-flight requests per URL rule for a Flask app, plus GET /metrics
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_start = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _metrics_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _metrics_end(exc):
+        start = g.pop("_metrics_start", None)
+        if start is None:
+            return
+        HTTP_IN_FLIGHT.dec()
+        label = request.url_rule.rule if request.url_rule else "<unmatched>"
+        HTTP_LATENCY.labels(request.method, label).observe(time.perf_counter() - start)
+        HTTP_REQUESTS.labels(request.method, label, g.pop("_metrics_status", 500)).inc()
+
+    @app.route(path)
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    return app
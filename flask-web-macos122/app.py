@@ -1,13 +1,22 @@
 # flask server with socketio and frontend
 # Production-ready Flask application
 
+import itertools
 import logging
 import os
 import signal
+import socket
 import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 from werkzeug.exceptions import HTTPException
+from metrics import instrument_flask, SOCKETIO_MESSAGES, SOCKETIO_CLIENTS
+from bus import BusHub, client_manager, private_url, socket_path
+import send_queue
 
 # Import eventlet for production WebSocket support
 try:
@@ -25,8 +34,36 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # main variables
+# WORKERS > 1 pre-forks that many Socket.IO processes on one listening socket, broadcasts reach every worker
+# through SOCKETIO_MESSAGE_QUEUE: unix:///path (built-in bus, by default in a new private directory) or
+# redis://host:6379/0 (any Redis-compatible server)
+WORKERS = max(1, int(os.environ.get('WORKERS', 1)))
+MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or (private_url('bus.sock') if WORKERS > 1 else None)
+TRANSPORTS = [t.strip() for t in os.environ.get('SOCKETIO_TRANSPORTS', 'polling,websocket').split(',') if t.strip()]
+if WORKERS > 1 and TRANSPORTS != ['websocket']:
+    # A long-polling session is several requests that may be accepted by different workers, a websocket is one
+    # connection that stays on its worker, so websocket-only transport keeps sessions sticky without a proxy
+    logger.warning(f"WORKERS={WORKERS}: using websocket-only transport instead of {TRANSPORTS}")
+    TRANSPORTS = ['websocket']
+
+# High-rate main_socket traffic: SOCKETIO_COALESCE_MS > 0 buffers messages and broadcasts them once per tick as
+# one exchange frame holding a list, SOCKETIO_ROOM_RATE caps messages per second per room (0 = no limit, bursts
+# up to SOCKETIO_ROOM_BURST), SOCKETIO_LOG_EVERY logs one message in N instead of every one
+COALESCE_MS = float(os.environ.get('SOCKETIO_COALESCE_MS', 0))
+ROOM_RATE = float(os.environ.get('SOCKETIO_ROOM_RATE', 0))
+ROOM_BURST = float(os.environ.get('SOCKETIO_ROOM_BURST', max(ROOM_RATE, 1)))
+LOG_EVERY = max(1, int(os.environ.get('SOCKETIO_LOG_EVERY', 1)))
+# SOCKETIO_SERIALIZER=msgpack encodes packets with MessagePack instead of JSON text (clients need the matching
+# parser). Either way bytes in a message travel as binary frames and are relayed as the same objects, never re-encoded.
+SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'json')
+# Slow consumers: SOCKETIO_SEND_QUEUE > 0 caps the events queued for each client (0 = unbounded), SOCKETIO_OVERFLOW
+# picks what happens when a client's queue is full: drop-oldest, drop-newest, coalesce-latest or disconnect
+SEND_QUEUE = int(os.environ.get('SOCKETIO_SEND_QUEUE', 0))
+OVERFLOW = os.environ.get('SOCKETIO_OVERFLOW', 'drop-oldest')
+
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+instrument_flask(app)  # per-route request metrics and GET /metrics
 
 # Security headers
 @app.after_request
@@ -40,6 +77,10 @@ def add_security_headers(response):
         response.headers[header] = value
     return response
 
+# unix:// uses the bus in bus.py, other urls go to Flask-SocketIO (RedisManager for redis://)
+manager = client_manager(MESSAGE_QUEUE)
+queue_options = {'client_manager': manager} if manager else {'message_queue': MESSAGE_QUEUE} if MESSAGE_QUEUE else {}
+
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
@@ -47,9 +88,15 @@ socketio = SocketIO(
     engineio_logger=False,
     ping_timeout=60,
     ping_interval=25,
-    async_mode=ASYNC_MODE
+    async_mode=ASYNC_MODE,
+    transports=TRANSPORTS,
+    **({'serializer': 'msgpack'} if SERIALIZER == 'msgpack' else {}),
+    **queue_options
 )
 
+if SEND_QUEUE > 0:
+    send_queue.install(socketio.server.eio, SEND_QUEUE, OVERFLOW)
+
 # Chrome DevTools endpoint (reduces log noise)
 @app.route('/.well-known/appspecific/com.chrome.devtools.json')
 def chrome_devtools():
@@ -82,25 +129,197 @@ def health_check():
 @app.route('/', methods=["GET", "POST"])
 def index():
     logger.info(f"Index page accessed from {request.remote_addr}")
-    return render_template('index.html')
+    return render_template('index.html', transports=TRANSPORTS)
+
+class RateLimiter:
+    """
+    Token bucket per room: rate messages per second on average, bursts of up to burst messages.
+    Room names come from clients, so buckets idle long enough to be full again are forgotten (a new one
+    starts full, nothing changes) and at most max_rooms are kept, the least recently used going first.
+    """
+    def __init__(self, rate, burst, max_rooms=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_rooms = max_rooms
+        self.refill_seconds = burst / rate
+        self.buckets = OrderedDict()  # room -> (tokens, last refill), least recently used first
+        self.lock = threading.Lock()
+
+    def allow(self, room):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(room, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[room] = (tokens - 1 if allowed else tokens, now)
+            while self.buckets:
+                _, (_, oldest) = next(iter(self.buckets.items()))
+                if now - oldest < self.refill_seconds and len(self.buckets) <= self.max_rooms:
+                    break
+                self.buckets.popitem(last=False)
+        return allowed
+
+class Coalescer:
+    """
+    Buffers messages per room and broadcasts each room's buffer as one exchange frame every tick, so serialization
+    and the per-client writes happen once per tick instead of once per message
+    """
+    def __init__(self, tick):
+        self.tick = tick
+        self.pending = {}  # room (None = every client) -> messages
+        self.lock = threading.Lock()
+        self.task = None
+
+    def add(self, room, data):
+        with self.lock:
+            self.pending.setdefault(room, []).append(data)
+            if self.task is None:  # started on first use, after any pre-forking
+                self.task = socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for room, batch in pending.items():
+            try:
+                socketio.emit('exchange', batch, to=room)
+                SOCKETIO_MESSAGES.labels('exchange', 'out').inc(room_size(room))
+            except Exception as e:
+                logger.error(f"Error broadcasting {len(batch)} coalesced messages: {e}")
+
+# Routing: clients subscribe to named rooms, optionally to some message types only. Each subscription is one
+# Socket.IO room, "room:<name>#<type>" or "room:<name>#*" for every type, so delivery walks the manager's
+# room -> clients index and costs O(subscribers) instead of O(connected clients).
+ALL_TYPES = '*'
+
+def room_key(room, message_type=ALL_TYPES):
+    return f"room:{room}#{message_type}"
+
+def valid_name(name):
+    return isinstance(name, str) and 0 < len(name) <= 128 and '#' not in name
+
+def room_size(room):
+    """
+    Clients of this worker in a Socket.IO room, every connected client for None
+    """
+    if room is None:
+        return SOCKETIO_CLIENTS.get()
+    return len(socketio.server.manager.rooms.get('/', {}).get(room, ()))
+
+def targets(data):
+    """
+    (room, Socket.IO rooms to deliver to) for a main_socket message, (None, [None]) for a broadcast to every client.
+    A message {"room": ..., "type": ...} goes to the room's all-types subscribers and to the ones of its type.
+    """
+    if not isinstance(data, dict) or data.get('room') is None:
+        return None, [None]
+    room, message_type = data['room'], data.get('type')
+    if not valid_name(room) or not (message_type is None or valid_name(message_type)):
+        raise ValueError("room and type must be non-empty strings without '#'")
+    return room, [room_key(room)] + ([room_key(room, message_type)] if message_type is not None else [])
+
+def describe(data):
+    """
+    Message for the log, binary buffers by size only (formatting them would copy and inflate every logged message)
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return f"<{len(data)} bytes>"
+    if isinstance(data, dict):
+        return {key: describe(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [describe(item) for item in data]
+    return data
+
+rate_limiter = RateLimiter(ROOM_RATE, ROOM_BURST) if ROOM_RATE > 0 else None
+coalescer = Coalescer(COALESCE_MS / 1000) if COALESCE_MS > 0 else None
+received = itertools.count(1)
 
 # pipes
 @socketio.on('main_socket')
 def main_socket(data):
-    logger.info(f"Socket message received from {request.sid}: {data}")
+    sampled = next(received) % LOG_EVERY == 0
+    if sampled:
+        logger.info(f"Socket message received from {request.sid}: {describe(data)}" + (f" (1 in {LOG_EVERY} logged)" if LOG_EVERY > 1 else ""))
+    SOCKETIO_MESSAGES.labels('main_socket', 'in').inc()
+    try:
+        room, to = targets(data)
+    except ValueError as e:
+        emit('error', {'message': str(e)})
+        return
+    if rate_limiter and not rate_limiter.allow(room):
+        SOCKETIO_MESSAGES.labels('main_socket', 'dropped').inc()
+        if sampled:
+            logger.warning(f"Rate limit of {ROOM_RATE}/s reached, dropping messages")
+        return
+    if coalescer:
+        for target in to:
+            coalescer.add(target, data)
+        return
     try:
-        emit('exchange', data, broadcast=True)
-        logger.info("Message broadcasted successfully")
+        for target in to:  # data is relayed as received, binary attachments included
+            if target is None:
+                emit('exchange', data, broadcast=True)
+            else:
+                emit('exchange', data, to=target)
+            SOCKETIO_MESSAGES.labels('exchange', 'out').inc(room_size(target))
+        if sampled:
+            logger.info("Message broadcasted successfully")
     except Exception as e:
         logger.error(f"Error broadcasting message: {e}")
         emit('error', {'message': 'Failed to broadcast message'})
 
+@socketio.on('subscribe')
+def subscribe(data):
+    """
+    {"room": "sensors"} receives every message sent to the room, {"room": "sensors", "types": ["temperature"]} only
+    those types. Subscribing again to a room replaces the previous types.
+    """
+    room = data.get('room') if isinstance(data, dict) else data
+    types = data.get('types') if isinstance(data, dict) else None
+    if not valid_name(room) or not (types is None or (isinstance(types, list) and types and all(valid_name(t) for t in types))):
+        emit('error', {'message': "subscribe needs a room and optional types, non-empty strings without '#'"})
+        return None
+    leave(room)
+    for message_type in types or [ALL_TYPES]:
+        join_room(room_key(room, message_type))
+    return {'room': room, 'types': types or ALL_TYPES}
+
+@socketio.on('unsubscribe')
+def unsubscribe(data):
+    room = data.get('room') if isinstance(data, dict) else data
+    leave(room)
+    return {'room': room}
+
+def leave(room):
+    prefix = room_key(room, '')
+    for joined in rooms():
+        if joined.startswith(prefix):
+            leave_room(joined)
+
+@app.route('/rooms')
+def list_rooms():
+    """
+    Subscribers per room and message type on this worker
+    """
+    listing = {}
+    for name, members in socketio.server.manager.rooms.get('/', {}).items():
+        if isinstance(name, str) and name.startswith('room:'):
+            room, message_type = name[len('room:'):].rsplit('#', 1)
+            listing.setdefault(room, {})[message_type] = len(members)
+    return jsonify(listing)
+
 @socketio.on('connect')
 def handle_connect():
+    SOCKETIO_CLIENTS.inc()
     logger.info(f"Client connected: {request.sid} from {request.remote_addr}")
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    SOCKETIO_CLIENTS.dec()
     logger.info(f"Client disconnected: {request.sid}")
 
 # Graceful shutdown handler
@@ -117,6 +336,76 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
+def serve_socket(listener, host, port):
+    """
+    Serve the app on an already listening socket (one pre-forked worker)
+    """
+    if ASYNC_MODE == 'eventlet':
+        import eventlet.wsgi
+        eventlet.wsgi.server(listener, app, log_output=False)
+    else:
+        from werkzeug.serving import make_server
+        make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+def serve_workers(host, port, workers):
+    """
+    Pre-fork workers that accept from one listening socket, this process runs the unix message bus and waits
+    """
+    pids = []
+
+    def stop_workers(sig=None, frame=None):
+        if sig is not None:
+            logger.info(f"Received signal {sig}, stopping workers")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    hub = BusHub(socket_path(MESSAGE_QUEUE)) if MESSAGE_QUEUE.startswith('unix://') else None
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(1024)
+        if hub:
+            hub.bind()  # before forking, so no worker ever connects to a socket someone else put there
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                if hub:
+                    hub.sock.close()  # the parent's, the hub's threads only start after forking
+                # The manager was created before forking, each worker needs its own id or it ignores the others' messages
+                socketio.server.manager.host_id = uuid.uuid4().hex
+                try:
+                    serve_socket(listener, host, port)
+                except Exception as e:
+                    logger.error(f"Worker {os.getpid()} failed: {e}")
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        listener.close()
+        if hub:
+            hub.serve()
+        logger.info(f"Started {workers} workers {pids} with message queue {MESSAGE_QUEUE}")
+
+        signal.signal(signal.SIGINT, stop_workers)
+        signal.signal(signal.SIGTERM, stop_workers)
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except BaseException:
+        stop_workers()  # don't leave workers behind when startup fails
+        raise
+    finally:
+        listener.close()
+        if hub:
+            hub.stop()
+            if not os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+                try:
+                    os.rmdir(os.path.dirname(hub.path))  # the private directory made for the default socket
+                except OSError:
+                    pass
+
 if __name__ == "__main__":
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
@@ -126,7 +415,10 @@ if __name__ == "__main__":
     logger.info("Press Ctrl+C to stop the server gracefully")
     
     try:
-        socketio.run(app, host=host, port=port, debug=False)
+        if WORKERS > 1:
+            serve_workers(host, port, WORKERS)
+        else:
+            socketio.run(app, host=host, port=port, debug=False)
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received, shutting down gracefully...")
         signal_handler(signal.SIGINT, None)
@@ -0,0 +1,226 @@
+# Message bus for running several Socket.IO worker processes on one host
+# A hub relays frames between the workers over a Unix socket, so a broadcast in one worker reaches the clients of all.
+# Frames are JSON (binary payloads are already base64 in python-socketio's messages), the socket belongs in a
+# directory only this user can write to, see private_url().
+# Redis-compatible servers (redis://, rediss://) are used through python-socketio's RedisManager instead.
+# Standalone hub: python bus.py unix:///tmp/flask-web.sock
+
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">I")
+SUBSCRIBE, PUBLISH = b"S", b"P"
+
+
+def socket_path(url):
+    """
+    Filesystem path of a unix:// message queue url
+    """
+    if not url.startswith("unix://"):
+        raise ValueError(f"Not a unix socket url: {url}")
+    return url[len("unix://"):]
+
+
+def private_url(name):
+    """
+    unix:// url of a socket in a new directory only this user can access ($XDG_RUNTIME_DIR or the temp dir)
+    """
+    directory = tempfile.mkdtemp(prefix="flask-web-", dir=os.environ.get("XDG_RUNTIME_DIR"))  # mode 0700
+    return f"unix://{os.path.join(directory, name)}"
+
+
+def check_socket_owner(path):
+    """
+    Refuse a socket path that isn't a socket of this user, another user may have put it there
+    """
+    info = os.lstat(path)
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a socket owned by this user")
+
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Bus connection closed")
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return recv_exact(sock, size)
+
+
+class BusHub:
+    """
+    Relays every published frame to every subscribed connection (the sender included, as Redis pub/sub does)
+    """
+    def __init__(self, path, send_timeout=5):
+        self.path = path
+        self.send_timeout = send_timeout
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.sock = None
+
+    def bind(self):
+        """
+        Listen on path, connections wait in the backlog until serve()
+        """
+        if os.path.lexists(self.path):
+            check_socket_owner(self.path)
+            os.unlink(self.path)  # left over from a hub that didn't shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)  # only this user may connect
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(128)
+        return self
+
+    def serve(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+        logger.info(f"Message bus listening on {self.path}")
+        return self
+
+    def start(self):
+        return self.bind().serve()
+
+    def stop(self):
+        if self.sock is not None:  # only remove the path when it is our socket
+            self.sock.close()
+            self.sock = None
+            if os.path.lexists(self.path):
+                os.unlink(self.path)
+
+    def _accept(self):
+        while self.sock is not None:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            role = recv_exact(conn, 1)
+            if role == SUBSCRIBE:
+                conn.settimeout(self.send_timeout)  # closed subscribers are dropped on their next send
+                with self.lock:
+                    self.subscribers.add(conn)
+                return
+            while True:
+                self.publish(recv_frame(conn))
+        except (ConnectionError, OSError):
+            pass
+        conn.close()
+
+    def publish(self, payload):
+        with self.lock:
+            self.frames += 1
+            for conn in list(self.subscribers):
+                try:
+                    send_frame(conn, payload)
+                except OSError:  # a subscriber that stops reading must not stall every worker
+                    logger.warning("Dropping a message bus subscriber that is not reading")
+                    self.subscribers.discard(conn)
+                    conn.close()
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """
+    Client manager that shares emits, rooms and disconnects between worker processes through a BusHub
+    """
+    name = "unix"
+
+    def __init__(self, url="unix:///tmp/flask-web.sock", channel="flask-socketio", write_only=False, logger=None):
+        self.path = socket_path(url)
+        self.publisher = None
+        self.publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self, role):
+        check_socket_owner(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(role)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _publish(self, data):
+        payload = json.dumps([self.channel, data]).encode()
+        with self.publish_lock:
+            for retries_left in (1, 0):
+                try:
+                    if self.publisher is None:
+                        self.publisher = self._connect(PUBLISH)
+                    return send_frame(self.publisher, payload)
+                except OSError as e:
+                    if self.publisher is not None:
+                        self.publisher.close()
+                        self.publisher = None
+                    if not retries_left:
+                        self._get_logger().error(f"Cannot publish to the message bus at {self.path}: {e}")
+
+    def _listen(self):
+        delay = 0.1
+        while True:
+            try:
+                sock = self._connect(SUBSCRIBE)
+            except OSError as e:
+                if isinstance(e, PermissionError):
+                    self._get_logger().error(f"Not using the message bus at {self.path}: {e}")
+                time.sleep(delay)  # the hub may not be up yet
+                delay = min(delay * 2, 5)
+                continue
+            delay = 0.1
+            try:
+                while True:
+                    channel, data = json.loads(recv_frame(sock))
+                    if channel == self.channel:
+                        yield data
+            except (ConnectionError, OSError, ValueError):
+                self._get_logger().error(f"Lost the message bus at {self.path}, reconnecting")
+            finally:
+                sock.close()
+
+
+def client_manager(url):
+    """
+    Client manager for a SOCKETIO_MESSAGE_QUEUE url, None for the ones Flask-SocketIO builds itself (redis://, ...)
+    """
+    if url and url.startswith("unix://"):
+        return UnixSocketManager(url)
+    return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    hub = BusHub(socket_path(sys.argv[1] if len(sys.argv) > 1 else "unix:///tmp/flask-web.sock")).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        hub.stop()
@@ -0,0 +1,142 @@
+# Bounded per-client outbound queues for Socket.IO, so one slow consumer can't grow the process's memory without limit
+# Engine.IO keeps an unbounded queue of packets per client, filled by emits and drained by the client's writer
+# (websocket) or its next poll. SendQueue replaces it with one that caps the queued Socket.IO events and applies an
+# overflow policy. Control packets (pings, connects, acks, disconnects) are never dropped, and an event's binary
+# attachments are kept or dropped together with it.
+
+import collections
+import threading
+
+from engineio import packet as eio_packet
+
+from metrics import SOCKETIO_QUEUE_DEPTH, SOCKETIO_QUEUE_DROPPED
+
+POLICIES = ("drop-oldest", "drop-newest", "coalesce-latest", "disconnect")
+
+EVENT, BINARY_EVENT = "2", "5"  # Socket.IO packet types in the text encoding
+MSGPACK_EVENT_HEADER = b"\xa4type\x02"  # {"type": 2, ...} as MsgPackPacket encodes it, after the map header
+
+
+def classify(pkt):
+    """
+    (droppable, binary attachments that follow) for an Engine.IO packet
+    """
+    if pkt is None or pkt.packet_type != eio_packet.MESSAGE:
+        return False, 0
+    data = pkt.data
+    if isinstance(data, str):
+        if data[:1] == EVENT:
+            return True, 0
+        if data[:1] == BINARY_EVENT:
+            return True, int(data[1:data.index("-")])
+        return False, 0
+    return data[1:7] == MSGPACK_EVENT_HEADER, 0
+
+
+class SendQueue:
+    """
+    Drop-in for the Engine.IO socket queue (put, get, task_done, join, qsize) holding at most limit events.
+    When full: drop-oldest discards the oldest queued event, drop-newest the new one, coalesce-latest every queued
+    event so only the newest is delivered, and disconnect drops the backlog and closes the connection.
+    """
+    def __init__(self, limit, policy, empty_exception, on_disconnect=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.limit = limit
+        self.policy = policy
+        self.empty_exception = empty_exception
+        self.on_disconnect = on_disconnect
+        self.groups = collections.deque()  # [droppable, packets], an event and its attachments
+        self.events = 0  # droppable groups queued
+        self.unfinished = 0
+        self.incomplete = None  # binary event waiting for its attachments: (group, attachments)
+        self.disconnecting = False
+        self.cond = threading.Condition()
+
+    def put(self, pkt, block=True, timeout=None):
+        disconnect = False
+        with self.cond:
+            if self.incomplete and pkt is not None and isinstance(pkt.data, bytes):
+                group, attachments = self.incomplete
+                group[1].append(pkt)
+                if len(group[1]) <= attachments:
+                    return
+                self.incomplete = None
+            else:
+                droppable, attachments = classify(pkt)
+                group = [droppable, [pkt]]
+                if attachments:
+                    self.incomplete = (group, attachments)
+                    return
+            if group[0] and self.limit and self.events >= self.limit:
+                if self.policy == "drop-newest":
+                    SOCKETIO_QUEUE_DROPPED.labels(self.policy).inc()
+                    return
+                self._drop(oldest_only=self.policy == "drop-oldest")
+                disconnect = self.policy == "disconnect" and not self.disconnecting
+                self.disconnecting = self.disconnecting or disconnect
+            self.groups.append(group)
+            self.events += group[0]
+            self.unfinished += len(group[1])
+            SOCKETIO_QUEUE_DEPTH.observe(self.events)
+            self.cond.notify()
+        if disconnect and self.on_disconnect:
+            self.on_disconnect(self)
+
+    def _drop(self, oldest_only):
+        kept = collections.deque()
+        dropped = 0
+        for group in self.groups:
+            if group[0] and not (oldest_only and dropped):
+                dropped += 1
+                self.unfinished -= len(group[1])
+            else:
+                kept.append(group)
+        self.groups = kept
+        self.events -= dropped
+        SOCKETIO_QUEUE_DROPPED.labels(self.policy).inc(dropped)
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.groups, timeout if block else 0):
+                raise self.empty_exception()
+            group = self.groups[0]
+            if group[0]:  # partly sent, the rest of it must follow
+                group[0] = False
+                self.events -= 1
+            pkt = group[1].pop(0)
+            if not group[1]:
+                self.groups.popleft()
+            return pkt
+
+    def task_done(self):
+        with self.cond:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.unfinished <= 0)
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(group[1]) for group in self.groups)
+
+    def empty(self):
+        return not self.qsize()
+
+
+def install(eio, limit, policy):
+    """
+    Give every new client of an Engine.IO server a SendQueue (existing clients keep their queues)
+    """
+    empty_exception = eio.get_queue_empty_exception()
+
+    def disconnect(queue):
+        for sid, client in list(eio.sockets.items()):
+            if client.queue is queue:
+                eio.start_background_task(eio.disconnect, sid)
+
+    SendQueue(limit, policy, empty_exception)  # validates the policy at startup rather than on the first connection
+    eio.create_queue = lambda *args, **kwargs: SendQueue(limit, policy, empty_exception, disconnect)
@@ -3,7 +3,8 @@
 const protocol = window.location.protocol;
 console.log(protocol);
 
-const socket = io.connect(protocol + '//' + document.domain + ":" + location.port); //port + namespace);
+// transports come from the server: websocket only when it runs several workers
+const socket = io.connect(protocol + '//' + document.domain + ":" + location.port, {transports: window.SOCKETIO_TRANSPORTS}); //port + namespace);
 console.log(socket);
 
 
@@ -15,6 +16,12 @@ async function send_server_and_back() {
 }
 
 socket.on('exchange', function(data) {
-    // receive from the server
+    // receive from the server, a list of messages when the server coalesces them
     console.log("received -> ", data)
-});
\ No newline at end of file
+});
+function subscribe(room, types) {
+    // receive the room's messages ({room, type, ...} sent to main_socket), all types unless given
+    socket.emit("subscribe", types ? {room: room, types: types} : {room: room}, function(ack) {
+        console.log("subscribed -> ", ack)
+    });
+}
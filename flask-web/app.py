@@ -1,13 +1,20 @@
 # flask server with socketio and frontend
 
+import os
 from flask import Flask, render_template
 from flask_socketio import SocketIO, send, emit
 from random import random
+from metrics import instrument_flask, SOCKETIO_MESSAGES, SOCKETIO_CLIENTS
 
 
 # main variables
+# SOCKETIO_SERIALIZER=msgpack encodes packets with MessagePack instead of JSON (clients need the matching parser),
+# bytes in a message are relayed as binary frames either way
+serializer = os.environ.get('SOCKETIO_SERIALIZER', 'json')
 app = Flask(__name__, template_folder='templates', static_folder='static')
-socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False)
+socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False,
+                    **({'serializer': 'msgpack'} if serializer == 'msgpack' else {}))
+instrument_flask(app) # request metrics and GET /metrics
 
 # startup
 @app.route('/', methods=["GET", "POST"])
@@ -18,7 +25,17 @@ def index():
 @socketio.on('main_socket')
 def main_socket(data):
     x = data
+    SOCKETIO_MESSAGES.labels('main_socket', 'in').inc()
     socketio.emit('exchange', x, broadcast=True) #, include_self=False)
+    SOCKETIO_MESSAGES.labels('exchange', 'out').inc(SOCKETIO_CLIENTS.get())
+
+@socketio.on('connect')
+def connect():
+    SOCKETIO_CLIENTS.inc()
+
+@socketio.on('disconnect')
+def disconnect():
+    SOCKETIO_CLIENTS.dec()
 
 
 if __name__ == "__main__":
@@ -3,29 +3,105 @@
 
 import os
 import io
-import glob
+import re
+import secrets
+import json
+import hashlib
+import stat
+import hmac
+import asyncio
+import time
 import shutil
 import platform
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import quote, unquote
+from dataclasses import dataclass, field
+from functools import partial
 
-from fastapi import FastAPI, UploadFile, HTTPException, File
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, HTTPException, File, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, UploadFile as StarletteUploadFile
+from starlette.staticfiles import NotModifiedResponse
+from pydantic import BaseModel
 
-from typing import List # integrate with older Python versions I think
+from typing import Any, Dict, List, Optional # integrate with older Python versions I think
 from PIL import Image
-from torchvision.models import ViT_L_32_Weights, vit_l_32
+import numpy as np
+import torch
+from torchvision.models import (
+    MobileNet_V3_Large_Weights, ResNet18_Weights, ViT_B_16_Weights, ViT_L_32_Weights,
+    mobilenet_v3_large, resnet18, vit_b_16, vit_l_32,
+)
 
 import logging
+from metrics import INFERENCE, REGISTRY, CONTENT_TYPE, UPLOAD_BYTES, MetricsMiddleware, observe_image_stages
 import requests
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
+# Metrics only this template has, on the shared registry so /metrics exports them with the standard ones
+BATCH_SIZE = REGISTRY.histogram("inference_batch_size", "Images per micro-batched forward pass", ("model",), buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_WAIT = REGISTRY.histogram("inference_batch_wait_seconds", "Time an image waited for its micro-batch", ("model",), buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0))
+JOB_QUEUE_WAIT = REGISTRY.histogram("job_queue_wait_seconds", "Time a queued job waited for a worker", buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0))
+JOB_RUN = REGISTRY.histogram("job_run_seconds", "Time a job took once started", buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0))
+
 image_dir = "images"
 upload_dir = "uploads"
 media_dir = "media" 
+derivative_dir = "derived"
+session_cookie = "session_id"  # API clients can send the same value as an X-Session-Id header
+session_ttl = float(os.environ.get("SESSION_TTL", 6 * 3600))  # idle seconds before a session's images are deleted
+session_max_images = int(os.environ.get("SESSION_MAX_IMAGES", 100))
+session_max_bytes = int(os.environ.get("SESSION_MAX_BYTES", 200 * 1024 * 1024))
+session_max_count = int(os.environ.get("SESSION_MAX_COUNT", 1000))
+session_secret = os.environ.get("SESSION_SECRET", "")  # keys session folder names, generated into session_key_file if unset
+session_key_file = "session.key"
+# name=WxH.format, generated from the resized upload and served immutable under /derived
+image_derivatives = os.environ.get("IMAGE_DERIVATIVES", "thumb=128x128.webp,medium=512x512.webp,medium-avif=512x512.avif")
+resize_target = tuple(int(v) for v in os.environ.get("RESIZE_TARGET", "512x512").split("x"))
+resize_filter = Image.Resampling[os.environ.get("RESIZE_FILTER", "lanczos").upper()]
+resize_quality = int(os.environ.get("RESIZE_QUALITY", 75))  # JPEG/WebP output
+resize_fast = os.environ.get("RESIZE_FAST", "1") == "1"  # JPEG DCT-domain downscale + reduce before the final filter
+upload_max_body_bytes = int(os.environ.get("UPLOAD_MAX_BODY_BYTES", 100 * 1024 * 1024))
+upload_max_request_memory = int(os.environ.get("UPLOAD_MAX_REQUEST_MEMORY", 512 * 1024 * 1024))  # decoded pixels per request
+upload_max_memory = int(os.environ.get("UPLOAD_MAX_MEMORY", 1024 * 1024 * 1024))  # decoded pixels across requests
+model_name = os.environ.get("MODEL_NAME", "vit_l_32")  # default when a request doesn't pick one
+model_preload = [n for n in os.environ.get("MODEL_PRELOAD", model_name).split(",") if n]
+model_memory_budget = int(os.environ.get("MODEL_MEMORY_BUDGET", 4 * 1024 ** 3))  # parameter bytes kept resident
+model_warmup_batch = int(os.environ.get("MODEL_WARMUP_BATCH", os.environ.get("BATCH_MAX_SIZE", 16)))
+inference_backend = os.environ.get("INFERENCE_BACKEND", "eager")  # eager, int8, torchscript, compile or onnx
+batch_max_size = int(os.environ.get("BATCH_MAX_SIZE", 16))
+batch_max_wait_ms = float(os.environ.get("BATCH_MAX_WAIT_MS", 10))
+executor_kind = os.environ.get("EXECUTOR", "thread")  # "thread" or "process" (one model copy per worker)
+executor_workers = int(os.environ.get("EXECUTOR_WORKERS", min(4, os.cpu_count() or 1)))
+executor_max_pending = int(os.environ.get("EXECUTOR_MAX_PENDING", 64))
+classify_top_k = int(os.environ.get("CLASSIFY_TOP_K", 5))
+classify_batch_max = int(os.environ.get("CLASSIFY_BATCH_MAX", 64))  # images per /classify/batch request, one forward pass
+job_workers = int(os.environ.get("JOB_WORKERS", 2))  # jobs classified concurrently, their images still share batches
+job_max_queued = int(os.environ.get("JOB_MAX_QUEUED", 10000))
+job_max_queued_bytes = int(os.environ.get("JOB_MAX_QUEUED_BYTES", 256 * 1024 * 1024))  # uploads held by unfinished jobs
+job_max_images = int(os.environ.get("JOB_MAX_IMAGES", 1000))
+job_chunk_size = int(os.environ.get("JOB_CHUNK_SIZE", batch_max_size))  # images of a job classified at a time
+job_ttl = float(os.environ.get("JOB_TTL", 600))  # seconds finished jobs stay readable
+result_cache_max_bytes = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+result_cache_ttl = float(os.environ.get("RESULT_CACHE_TTL", 24 * 3600))  # seconds, 0 = never expire
+result_cache_dir = os.environ.get("RESULT_CACHE_DIR", "")  # empty = memory only
+tensor_dir = "tensors"
+precompute_tensors = os.environ.get("PRECOMPUTE_TENSORS", "1") == "1"  # store model-ready tensors at upload
+weights_dir = os.environ.get("WEIGHTS_DIR", "weights")  # content-addressed weight cache, keep it on a volume
+weights_mirror = os.environ.get("WEIGHTS_MIRROR", "")  # base URL serving the same file names as download.pytorch.org
+weights_offline = os.environ.get("WEIGHTS_OFFLINE", "0") == "1"  # never touch the network, use the cache only
+weights_sha256 = os.environ.get("WEIGHTS_SHA256", "")  # "resnet18-f37072fd.pth=<full sha256>,..." pins exact files
+weights_prefetch = os.environ.get("WEIGHTS_PREFETCH", "preload")  # "preload" (MODEL_PRELOAD), "all" or "none"
 
 os_details = {
     "System": platform.system(),
@@ -53,13 +129,1412 @@ def setup_root_app_directory():
     if not os.path.exists(upload_dir):
         os.makedirs(upload_dir)
         print(f"Created directory: {upload_dir}")
+    if not os.path.exists(derivative_dir):
+        os.makedirs(derivative_dir)
+        print(f"Created directory: {derivative_dir}")
+
+
+def get_rss_bytes():
+    """
+    Resident memory of this process in bytes (None if the platform can't tell us)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if platform.system() == "Darwin" else max_rss * 1024  # peak, not current
+
+
+
+# name -> (builder, weights), add torchvision models here to make them loadable
+MODEL_BUILDERS = {
+    "vit_l_32": (vit_l_32, ViT_L_32_Weights.DEFAULT),  # .IMAGENET1K_V1, ~1.2 GB, most accurate
+    "vit_b_16": (vit_b_16, ViT_B_16_Weights.DEFAULT),  # ~350 MB
+    "resnet18": (resnet18, ResNet18_Weights.DEFAULT),  # ~45 MB
+    "mobilenet_v3_large": (mobilenet_v3_large, MobileNet_V3_Large_Weights.DEFAULT),  # ~22 MB, fastest
+}
+
+
+def check_model_settings():
+    """
+    Fail at startup, naming the setting, rather than with a bare KeyError on the first lookup
+    """
+    for setting, names in (("MODEL_NAME", [model_name]), ("MODEL_PRELOAD", model_preload)):
+        unknown = [n for n in names if n not in MODEL_BUILDERS]
+        if unknown:
+            raise ValueError(f"Unknown model in {setting}: {', '.join(unknown)} (expected one of {', '.join(MODEL_BUILDERS)})")
+    if weights_prefetch not in ("preload", "all", "none"):
+        raise ValueError(f"Unknown WEIGHTS_PREFETCH: {weights_prefetch} (expected preload, all or none)")
+
+
+check_model_settings()
+
+
+def download_with_resume(url, path, chunk_size=1024 * 1024, timeout=30, retries=3):
+    """
+    Download url to path, continuing from whatever is already in path with a Range request.
+    Retries dropped connections from where they stopped. Returns the number of bytes fetched.
+    """
+    fetched = 0
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416:  # nothing left to fetch
+                    return fetched
+                r.raise_for_status()
+                # 206 continues the partial file, a 200 means the server ignored Range: start over
+                with open(path, "ab" if r.status_code == 206 else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        fetched += len(chunk)
+            return fetched
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as err:
+            if attempt == retries:
+                raise
+            logging.warning(f"Download of {url} interrupted ({err}), resuming")
+            time.sleep(min(2 ** attempt, 10))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def temp_path(path):
+    """
+    Private name to write path under before os.replace(), so concurrent writers
+    (process workers, executor threads) never share a half-written file
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+class WeightCache:
+    """
+    Content-addressed store for model weights: blobs/<sha256> plus index.json mapping file names to hashes.
+    Downloads resume from partial/<file>.part and only enter the store once their SHA-256 matches
+    (the pinned hash if given, else the hash prefix torchvision puts in file names), so an
+    interrupted or corrupted transfer never leaves a bad blob. Offline, only the store is used.
+    """
+    HASH_PREFIX = re.compile(r"-([a-f0-9]{8,64})\.")  # resnet18-f37072fd.pth
+
+    def __init__(self, root, mirror="", offline=False, pinned=None):
+        self.root = root
+        self.mirror = mirror.rstrip("/")
+        self.offline = offline
+        self.pinned = pinned or {}  # file name -> full sha256
+        self.downloads: Dict[str, Dict[str, Any]] = {}  # file name -> what the last fetch did
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def url(self, url):
+        return f"{self.mirror}/{url.rsplit('/', 1)[-1]}" if self.mirror else url
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.root, "index.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, filename, sha256):
+        index = self._read_index()
+        index[filename] = sha256
+        path = os.path.join(self.root, "index.json")
+        tmp = temp_path(path)
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, path)
+
+    def lookup(self, filename):
+        """
+        Path of the cached blob for a file name, or None
+        """
+        sha256 = self.pinned.get(filename) or self._read_index().get(filename)
+        if sha256 and os.path.exists(self.blob_path(sha256)):
+            return self.blob_path(sha256)
+        return None
+
+    def check(self, filename, sha256):
+        expected = self.pinned.get(filename)
+        if expected:
+            return sha256 == expected.lower()
+        match = self.HASH_PREFIX.search(filename)
+        return sha256.startswith(match.group(1)) if match else True  # nothing to check against
+
+    def fetch(self, url):
+        """
+        Local path of the weights at url, downloading and verifying them if they aren't cached yet
+        """
+        filename = url.rsplit("/", 1)[-1]
+        with self._lock:
+            lock = self._locks.setdefault(filename, threading.Lock())
+        with lock:  # one download per file, other threads wait for it
+            start = time.perf_counter()
+            path = self.lookup(filename)
+            if path:
+                self.downloads.setdefault(filename, {"source": "cache", "seconds": round(time.perf_counter() - start, 3)})
+                return path
+            if self.offline:
+                raise FileNotFoundError(f"{filename} is not in the weight cache {self.root} and WEIGHTS_OFFLINE=1")
+            os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+            os.makedirs(os.path.join(self.root, "partial"), exist_ok=True)
+            part = os.path.join(self.root, "partial", f"{filename}.part")
+            resumed_from = os.path.getsize(part) if os.path.exists(part) else 0
+            fetched = download_with_resume(self.url(url), part)
+            sha256 = file_sha256(part)
+            if not self.check(filename, sha256):
+                os.remove(part)  # don't resume from corrupt bytes next time
+                raise ValueError(f"SHA-256 mismatch for {filename}: got {sha256}")
+            os.replace(part, self.blob_path(sha256))
+            self._write_index(filename, sha256)
+            self.downloads[filename] = {
+                "source": "network",
+                "sha256": sha256,
+                "bytes": os.path.getsize(self.blob_path(sha256)),
+                "fetched_bytes": fetched,
+                "resumed_from": resumed_from,
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+            logging.info(f"Fetched {filename} in {self.downloads[filename]['seconds']}s ({fetched} bytes, resumed from {resumed_from})")
+            return self.blob_path(sha256)
+
+    def prefetch(self, urls):
+        """
+        Fetch several weight files in parallel, returns the wall time in seconds
+        """
+        start = time.perf_counter()
+        urls = list(dict.fromkeys(urls))
+        if urls:
+            with ThreadPoolExecutor(max_workers=min(4, len(urls)), thread_name_prefix="prefetch") as pool:
+                list(pool.map(self.fetch, urls))
+        return time.perf_counter() - start
+
+    def stats(self):
+        index = self._read_index()
+        return {
+            "root": self.root,
+            "offline": self.offline,
+            "files": len(index),
+            "bytes": sum(os.path.getsize(self.blob_path(h)) for h in set(index.values()) if os.path.exists(self.blob_path(h))),
+            "downloads": self.downloads,
+        }
+
+
+weight_cache = WeightCache(
+    weights_dir,
+    mirror=weights_mirror,
+    offline=weights_offline,
+    pinned=dict(item.split("=", 1) for item in weights_sha256.split(",") if "=" in item),
+)
+startup_timings: Dict[str, float] = {}  # seconds per startup stage, the last one is the cold-start total
+
+
+INFERENCE_BACKENDS = ("eager", "int8", "torchscript", "compile", "onnx")
+
+
+def example_input(weights, batch_size=1):
+    """
+    Zero batch shaped like the output of the weights' inference transforms
+    """
+    crop = list(getattr(weights.transforms(), "crop_size", [224]))
+    return torch.zeros(batch_size, 3, crop[0], crop[-1])
+
+
+class OnnxRuntimeModel:
+    """
+    ONNX export of a model run by onnxruntime (optional dependency), called like the torch module
+    """
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("INFERENCE_BACKEND=onnx needs onnxruntime, install with: pip install onnx onnxruntime")
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @classmethod
+    def export(cls, name, model, example):
+        os.makedirs("models", exist_ok=True)
+        _, weights = MODEL_BUILDERS[name]
+        path = os.path.join("models", f"{name}-{hashlib.sha256(str(weights).encode()).hexdigest()[:12]}.onnx")
+        if not os.path.exists(path):
+            tmp = temp_path(path)
+            try:
+                torch.onnx.export(
+                    model, example, tmp,
+                    external_data=False,  # one file, so the rename below moves the weights too
+                    input_names=["input"], output_names=["logits"],
+                    dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                )
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return cls(path)
+
+    def __call__(self, batch):
+        return torch.from_numpy(self.session.run(None, {self.input_name: batch.numpy()})[0])
+
+
+def apply_backend(name, model, backend, example):
+    """
+    Turn an eval-mode model into the selected inference backend
+    """
+    if backend == "eager":
+        return model
+    if backend == "int8":
+        # Dynamic quantization of the Linear layers, which hold nearly all ViT weights
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "torchscript":
+        with torch.no_grad():
+            return torch.jit.optimize_for_inference(torch.jit.trace(model, example))
+    if backend == "compile":
+        # Batch size varies with load, a dynamic batch dimension avoids a recompile per size (see warmup())
+        return torch.compile(model, dynamic=True)
+    if backend == "onnx":
+        return OnnxRuntimeModel.export(name, model, example)
+    raise ValueError(f"Unknown inference backend: {backend} (expected one of {', '.join(INFERENCE_BACKENDS)})")
+
+
+@dataclass
+class LoadedModel:
+    name: str
+    backend: str
+    model: Any  # torch.nn.Module, or OnnxRuntimeModel
+    weights: Any
+    preprocess: Any
+    categories: List[str]
+    load_seconds: float
+    param_bytes: int
+    rss_delta_bytes: Optional[int]
+    warmup_seconds: float = 0.0
+
+
+def warmup(loaded, batch_size):
+    """
+    Run dummy batches so lazy initialisation, JIT compilation and allocator growth
+    happen now rather than on the first real request. Batch 1 is always included:
+    it is what a lone request gets, and torch.compile specialises on it.
+    """
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for size in sorted({1, batch_size}):
+            loaded.model(example_input(loaded.weights, size))
+    loaded.warmup_seconds = time.perf_counter() - start
+
+
+def _tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):  # packed int8 Linear params are (weight, bias)
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+def state_dict_bytes(model):
+    return sum(_tensor_bytes(v) for v in model.state_dict().values())
+
+
+def backend_weight_bytes(model, eager_bytes):
+    """
+    Weight bytes the backend actually keeps: the ONNX file, the int8 packed weights, ...
+    Frozen TorchScript hides its weights in the graph but keeps their dtype, so it counts as eager_bytes.
+    """
+    if isinstance(model, OnnxRuntimeModel):
+        return os.path.getsize(model.path)
+    if isinstance(model, torch.jit.ScriptModule):
+        return eager_bytes
+    return state_dict_bytes(model)
+
+
+def build_model(name, backend="eager"):
+    """
+    Build a model with its weights in eval mode for the given inference backend
+    """
+    if name not in MODEL_BUILDERS:
+        raise KeyError(f"Unknown model: {name}")
+    builder, weights = MODEL_BUILDERS[name]
+    rss_before = get_rss_bytes()
+    start = time.perf_counter()
+    # Same as builder(weights=weights), but the file comes from the verified weight cache
+    model = builder(weights=None, num_classes=len(weights.meta["categories"]))
+    model.load_state_dict(torch.load(weight_cache.fetch(weights.url), map_location="cpu", weights_only=True))
+    model.eval()
+    eager_bytes = state_dict_bytes(model)
+    runnable = apply_backend(name, model, backend, example_input(weights))
+    loaded = LoadedModel(
+        name=name,
+        backend=backend,
+        model=runnable,
+        weights=weights,
+        preprocess=weights.transforms(),
+        categories=weights.meta["categories"],
+        load_seconds=time.perf_counter() - start,
+        param_bytes=backend_weight_bytes(runnable, eager_bytes),
+        rss_delta_bytes=None,
+    )
+    rss_after = get_rss_bytes()
+    if rss_before is not None and rss_after is not None:
+        loaded.rss_delta_bytes = rss_after - rss_before
+    return loaded
+
+
+class ModelRegistry:
+    """
+    Loads models on first use (in eval mode, warmed up) and shares them across requests.
+    Resident models are kept under memory_budget parameter bytes, least recently used
+    ones are evicted first. A batch already running on an evicted model finishes normally.
+    """
+    def __init__(self, memory_budget, warmup_batch=1):
+        self.memory_budget = memory_budget
+        self.warmup_batch = warmup_batch
+        self.evictions = 0
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()  # guards _models and _load_locks, never held while loading
+        self._load_locks: Dict[str, threading.Lock] = {}  # one per model name, so a model is built once
+
+    def load(self, name):
+        with self._lock:
+            if name in self._models:
+                return self._models[name]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            loaded = self._models.get(name)  # loaded by the thread we waited for
+            if loaded is not None:
+                return loaded
+            # Other models keep serving while this one builds and warms up
+            loaded = build_model(name, inference_backend)
+            if self.warmup_batch:
+                warmup(loaded, self.warmup_batch)
+            with self._lock:
+                self._models[name] = loaded
+                self._evict(keep=name)
+            logging.info(f"Loaded model {name} ({loaded.backend}) in {loaded.load_seconds:.2f}s, warmup {loaded.warmup_seconds:.2f}s")
+            return loaded
+
+    def _evict(self, keep):
+        while self.resident_bytes() > self.memory_budget and len(self._models) > 1:
+            name = next(n for n in self._models if n != keep)
+            del self._models[name]
+            self.evictions += 1
+            logging.info(f"Evicted model {name} to stay under the memory budget")
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def get(self, name):
+        loaded = self._models.get(name)
+        if loaded is None:
+            return self.load(name)
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+        return loaded
+
+    def resident_bytes(self):
+        return sum(m.param_bytes for m in list(self._models.values()))
+
+    def stats(self):
+        return {
+            name: {
+                "backend": m.backend,
+                "load_seconds": round(m.load_seconds, 3),
+                "warmup_seconds": round(m.warmup_seconds, 3),
+                "param_bytes": m.param_bytes,
+                "rss_delta_bytes": m.rss_delta_bytes,
+            }
+            for name, m in list(self._models.items())
+        }
+
+
+model_registry = ModelRegistry(model_memory_budget, model_warmup_batch)
+
+
+
+def classify_tensor_batch(loaded, batch):
+    """
+    One forward pass over an (N, C, H, W) batch, returns (N, classes) probabilities
+    """
+    with torch.inference_mode():
+        return loaded.model(batch).softmax(1)
+
+
+class MicroBatcher:
+    """
+    Collects single-image requests into one forward pass.
+    A batch is flushed when it reaches max_size or the oldest request waited max_wait_ms.
+    Batch sizes and waits go to the /metrics histograms, labelled with the model name.
+    """
+    def __init__(self, run_batch, max_size=16, max_wait_ms=10.0, name="default"):
+        self.run_batch = run_batch  # async, N (C, H, W) tensors -> (N, classes), stacks them off the loop
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = BATCH_SIZE.labels(name)
+        self.queue_wait = BATCH_WAIT.labels(name)
+        self._queue = None
+        self._task = None
+        self._inflight = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._inflight):
+            task.cancel()
+
+    async def submit(self, tensor):
+        """Queue one preprocessed (C, H, W) tensor and wait for its row of the batch output"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self._queue.put((tensor, future, loop.time()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = items[0][2] + self.max_wait
+            while len(items) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next batch can fill while this one runs
+            task = asyncio.create_task(self._flush(items, loop))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _flush(self, items, loop):
+        now = loop.time()
+        self.batch_sizes.observe(len(items))
+        for _, _, queued_at in items:
+            self.queue_wait.observe(now - queued_at)
+        try:
+            outputs = await self.run_batch([tensor for tensor, _, _ in items])
+        except Exception as e:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for i, (_, future, _) in enumerate(items):
+            if not future.done():  # the client may have gone away
+                future.set_result(outputs[i])
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "inflight_batches": len(self._inflight),
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+        }
+
+
+# Executor entry points: top-level so process workers can unpickle them,
+# the registry they use is the worker's own copy in process mode
+def _init_worker(names, threads):
+    torch.set_num_threads(threads)
+    for name in names:
+        model_registry.load(name)
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def registry_stats():
+    """Models resident in this process, in a worker it describes the worker's own registry"""
+    return {
+        "models": model_registry.stats(),
+        "resident_param_bytes": model_registry.resident_bytes(),
+        "evictions": model_registry.evictions,
+        "process_rss_bytes": get_rss_bytes(),
+    }
+
+
+def _worker_stats(hold):
+    time.sleep(hold)  # keeps this worker busy so the other calls of the round go to other workers
+    return os.getpid(), registry_stats()
+
+
+def _run_model_batch(name, tensors):
+    # Stacked here rather than by the batcher: copying N images is real work for the event loop
+    return classify_tensor_batch(model_registry.get(name), torch.stack(tensors))
+
+
+def _preprocess_image_bytes(name, image_data):
+    return _preprocess_image(name, io.BytesIO(image_data))
+
+
+def _preprocess_images(name, images):
+    return torch.stack([_preprocess_image(name, io.BytesIO(data)) for data in images])
+
+
+def _classify_batch_top_k(name, tensors, k):
+    """
+    Stack, forward pass and topk over the whole batch in the worker, so only (N, k) crosses back
+    """
+    probabilities = classify_tensor_batch(model_registry.get(name), torch.stack(tensors))
+    return probabilities.topk(min(k, probabilities.shape[1]), dim=1)
+
+
+def _preprocess_image(name, source):
+    _, weights = MODEL_BUILDERS[name]
+    with Image.open(source) as img:
+        return weights.transforms()(img.convert("RGB"))
+
+
+def _write_preprocessed_tensor(name, image_path, tensor_path):
+    start = time.perf_counter()
+    array = _preprocess_image(name, image_path).numpy()
+    tmp = temp_path(tensor_path)
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, tensor_path)
+    return (time.perf_counter() - start) * 1000
+
+
+class BoundedExecutor:
+    """
+    Runs CPU-bound work (decode, resize, inference) off the event loop.
+    At most max_pending jobs may be queued or running, beyond that callers get a 503.
+    """
+    def __init__(self, kind="thread", workers=4, max_pending=64):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        self.pids = []
+        self._pool = None
+
+    async def start(self, preload):
+        if self.kind == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+            return
+        # spawn rather than fork: forking a process with live torch/OpenMP threads can deadlock
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(preload, threads),
+        )
+        # Start every worker now so the first requests don't pay for the model load
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self._pool, _worker_ready) for _ in range(self.workers)))
+        self.pids = sorted(set(pids))
+        logging.info(f"Process executor ready, workers: {self.pids}")
+
+    async def worker_stats(self, rounds=3, hold=0.05):
+        """
+        {pid: registry_stats()} of the process workers. A pool can't address a worker, so each round
+        sends one call per worker that holds it for hold seconds. Workers busy for the whole time are missing.
+        """
+        loop = asyncio.get_running_loop()
+        stats = {}
+        for _ in range(rounds):
+            results = await asyncio.gather(*(loop.run_in_executor(self._pool, _worker_stats, hold) for _ in range(self.workers)))
+            stats.update(results)
+            if len(stats) >= self.workers:
+                break
+        return stats
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+executor = BoundedExecutor(executor_kind, executor_workers, executor_max_pending)
+
+batchers: Dict[str, MicroBatcher] = {}
+
+
+async def ensure_loaded(name):
+    """
+    Load a model (downloading its weights if needed) on the default threadpool rather than inside the
+    bounded executor, so a cold load doesn't hold executor slots that batches for loaded models need.
+    Process workers each keep their own registry and still load on their first batch.
+    """
+    if executor.kind == "thread" and not model_registry.is_loaded(name):
+        await run_in_threadpool(model_registry.load, name)
+
+
+def get_batcher(name):
+    """
+    One micro-batcher per model, started on first use
+    """
+    batcher = batchers.get(name)
+    if batcher is None:
+        async def run_batch(tensors):
+            await ensure_loaded(name)
+            with INFERENCE.labels(name).time():
+                return await executor.run(_run_model_batch, name, tensors)
+
+        batcher = batchers[name] = MicroBatcher(
+            run_batch,
+            max_size=batch_max_size,
+            max_wait_ms=batch_max_wait_ms,
+            name=name,
+        )
+        batcher.start()
+    return batcher
+
+
+def resolve_model_name(name):
+    name = name or model_name
+    if name not in MODEL_BUILDERS:
+        raise HTTPException(status_code=400, detail=f"Unknown model {name}, available: {', '.join(MODEL_BUILDERS)}")
+    return name
+
+
+def preprocess_id(name):
+    """
+    Identifies model + weights, which fix the inference transforms
+    """
+    _, weights = MODEL_BUILDERS[name]
+    return f"{name}:{weights}"
+
+
+def model_cache_id(name):
+    """
+    Identifies model + weights + backend, so cached results are dropped when any changes
+    (quantized and exported backends don't give bit-identical scores)
+    """
+    return f"{preprocess_id(name)}:{inference_backend}"
+
+
+def top_k_predictions(prediction, categories, k):
+    return top_k_batch(*prediction.unsqueeze(0).topk(min(k, prediction.shape[-1])), categories)[0]
+
+
+def top_k_batch(scores, class_ids, categories):
+    """
+    (N, k) scores and class ids from one topk over the batch -> per-image lists, one .tolist() per tensor
+    """
+    return [
+        [{"category": categories[i], "score": s} for i, s in zip(row_ids, row_scores)]
+        for row_ids, row_scores in zip(class_ids.tolist(), scores.tolist())
+    ]
+
+
+class ResultCache:
+    """
+    LRU + TTL cache of classification results keyed by sha256(image bytes) and model id.
+    The memory tier is bounded by the JSON size of its entries, the optional disk
+    tier keeps one JSON file per key and survives restarts.
+    """
+    def __init__(self, max_bytes, ttl=0, directory=""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (stored_at, size, value)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(data, model_id):
+        return hashlib.sha256(model_id.encode() + b"\0" + data).hexdigest()
+
+    def _expired(self, stored_at):
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self._remove(key)
+        value = self._disk_get(key)
+        if value is not None:
+            self.disk_hits += 1
+            self._store(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._store(key, value)
+        self._disk_put(key, value)
+
+    def _store(self, key, value):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time(), size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.directory:
+            return
+        path = self._disk_path(key)
+        try:
+            tmp = temp_path(path)
+            with open(tmp, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, path)  # readers never see a half-written file
+        except OSError as e:
+            logging.warning(f"Could not write cache entry {path}: {e}")
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "disk_dir": self.directory or None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+result_cache = ResultCache(result_cache_max_bytes, result_cache_ttl, result_cache_dir)
+
+
+
+class TensorStore:
+    """
+    Model-ready (normalized) tensors of stored images as .npy files, loaded memory-mapped.
+    Files live in a folder named after the model + weights id, so changing either
+    invalidates all of them, and a tensor older than its image is ignored.
+    """
+    def __init__(self, root, model_id):
+        self.root = root
+        self.directory = os.path.join(root, hashlib.sha256(model_id.encode()).hexdigest()[:16])
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, session_key, image_id):
+        return os.path.join(self.directory, session_key, f"{image_id}.npy")
+
+    def prepare(self):
+        """Create this model's folder and drop the ones left by other models or weights"""
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in os.listdir(self.root):
+            stale = os.path.join(self.root, entry)
+            if stale != self.directory and os.path.isdir(stale):
+                shutil.rmtree(stale, ignore_errors=True)
+                logging.info(f"Removed stale tensor store: {stale}")
+
+    def load(self, session_key, image_id, image_path):
+        path = self.path(session_key, image_id)
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(image_path):
+                raise FileNotFoundError(path)
+            array = np.load(path, mmap_mode="c")  # copy-on-write map, nothing is read until the batch is stacked
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.from_numpy(array)
+
+    def stats(self):
+        return {"enabled": precompute_tensors, "directory": self.directory, "hits": self.hits, "misses": self.misses}
+
+
+tensor_store = TensorStore(tensor_dir, preprocess_id(model_name))
+
+
+def file_info(paths):
+    """
+    Index fields of a stored image: bytes of all its files, mtime and sha256 of the image itself
+    """
+    return {
+        "bytes": sum(os.path.getsize(path) for path in paths if os.path.exists(path)),
+        "mtime": os.path.getmtime(paths[0]),
+        "sha256": file_sha256(paths[0]),
+    }
+
+
+@dataclass
+class Session:
+    id: str
+    last_seen: float
+    images: "OrderedDict[str, dict]" = field(default_factory=OrderedDict)  # name -> url, derivatives, paths, bytes, mtime, sha256
+    bytes: int = 0
+
+
+def load_session_secret(path):
+    """
+    SESSION_SECRET, or a random one kept in path so session folders survive a restart
+    """
+    if session_secret:
+        return session_secret.encode()
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        secret = secrets.token_bytes(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+
+
+class SessionStore:
+    """
+    Per-session image folders (images/<key>/, derived/<key>/, ...) with an
+    in-memory index, per-session quotas and idle expiry.
+    Folders and the index use an HMAC of the session ID as the key, so image URLs
+    never reveal the ID, which is the only credential of a session.
+    Going over a quota evicts the session's oldest images. The index is only touched
+    on the event loop, files are deleted in the thread pool.
+    """
+    def __init__(self, roots, secret, ttl, max_images, max_bytes, max_sessions):
+        self.roots = roots  # image_dir first
+        self.secret = secret
+        self.ttl = ttl
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()  # least recently seen first
+        self.evicted_images = 0
+        self.expired_sessions = 0
 
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(18)
 
-app = FastAPI(title="fastapi-image-app")
+    @staticmethod
+    def valid_id(session_id):
+        return bool(session_id) and re.fullmatch(r"[A-Za-z0-9_-]{16,64}", session_id) is not None
+
+    @staticmethod
+    def valid_key(key):
+        return re.fullmatch(r"[0-9a-f]{32}", key) is not None
+
+    def key(self, session_id):
+        """Public folder name of a session"""
+        return hmac.new(self.secret, session_id.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def folder(self, session_id, root=None):
+        return os.path.join(root or self.roots[0], self.key(session_id))
+
+    def make_folders(self, session_id):
+        for root in self.roots:
+            os.makedirs(self.folder(session_id, root), exist_ok=True)
+
+    def touch(self, session_id, create=True):
+        key = self.key(session_id)
+        session = self.sessions.get(key)
+        if session is None:
+            if not create:
+                return None
+            session = self.sessions[key] = Session(key, time.time())
+        session.last_seen = time.time()
+        self.sessions.move_to_end(key)
+        return session
+
+    def image_urls(self, session_id):
+        session = self.sessions.get(self.key(session_id))
+        return [image["url"] for image in session.images.values()] if session else []
+
+    def add(self, session_id, name, url, derivatives, paths, info=None):
+        """
+        Index a stored image (info from file_info(), read from disk if not given),
+        returns the paths that are no longer referenced
+        """
+        session = self.touch(session_id)
+        garbage = []
+        old = session.images.pop(name, None)
+        if old:
+            session.bytes -= old["bytes"]
+            garbage += [path for path in old["paths"] if path not in paths]
+        info = info or file_info(paths)
+        session.images[name] = {"url": url, "derivatives": derivatives, "paths": paths, **info}
+        session.bytes += info["bytes"]
+        while len(session.images) > 1 and (len(session.images) > self.max_images or session.bytes > self.max_bytes):
+            _, evicted = session.images.popitem(last=False)
+            session.bytes -= evicted["bytes"]
+            garbage += evicted["paths"]
+            self.evicted_images += 1
+        return garbage
+
+    def latest(self, session_id):
+        """Name of the session's newest image or None, O(1) since images are kept in upload order"""
+        session = self.sessions.get(self.key(session_id))
+        return next(reversed(session.images), None) if session else None
+
+    def image(self, session_id, name):
+        session = self.sessions.get(self.key(session_id))
+        return session.images.get(name) if session else None
+
+    def listing(self, session_id):
+        """The session's images, oldest first, without touching the disk"""
+        session = self.sessions.get(self.key(session_id))
+        if session is None:
+            return []
+        return [
+            {"name": name, "url": image["url"], "bytes": image["bytes"], "mtime": image["mtime"], "sha256": image["sha256"], "derivatives": image["derivatives"]}
+            for name, image in session.images.items()
+        ]
+
+    def clear(self, session_id):
+        """Forget a session, returns its folders"""
+        return self._clear(self.key(session_id))
+
+    def _clear(self, key):
+        self.sessions.pop(key, None)
+        return [os.path.join(root, key) for root in self.roots]
+
+    def expire(self):
+        """Forget sessions idle for longer than ttl (or over max_sessions), returns their folders"""
+        now = time.time()
+        folders = []
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if now - session.last_seen <= self.ttl and len(self.sessions) <= self.max_sessions:
+                break
+            folders += self._clear(key)
+            self.expired_sessions += 1
+        return folders
+
+    def rebuild(self):
+        """
+        Index the session folders already on disk, so sessions survive a restart
+        """
+        if not os.path.isdir(self.roots[0]):
+            return
+        for key in os.listdir(self.roots[0]):
+            folder = os.path.join(self.roots[0], key)
+            if not self.valid_key(key) or not os.path.isdir(folder):
+                continue
+            names = sorted(os.listdir(folder), key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+            related = {root: os.listdir(os.path.join(root, key)) for root in self.roots[1:] if os.path.isdir(os.path.join(root, key))}
+            session = Session(key, os.path.getmtime(folder))
+            for name in names:
+                derivatives = {}
+                paths = [os.path.join(folder, name)]
+                for root, files in related.items():
+                    for filename in files:
+                        match = re.fullmatch(re.escape(name) + r"\.[0-9a-f]{16}\.([^.]+)\.[^.]+", filename)
+                        if match:
+                            derivatives[match.group(1)] = path_url(os.path.join(root, key, filename))
+                        elif not (filename.startswith(name + ".") and "." not in filename[len(name) + 1:]):
+                            continue
+                        paths.append(os.path.join(root, key, filename))
+                info = file_info(paths)
+                session.images[name] = {"url": path_url(os.path.join(folder, name)), "derivatives": derivatives, "paths": paths, **info}
+                session.bytes += info["bytes"]
+                session.last_seen = max(session.last_seen, info["mtime"])
+            self.sessions[key] = session
+        for key in sorted(self.sessions, key=lambda k: self.sessions[k].last_seen):
+            self.sessions.move_to_end(key)
+        logging.info(f"Indexed {len(self.sessions)} sessions from disk")
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "images": sum(len(s.images) for s in self.sessions.values()),
+            "bytes": sum(s.bytes for s in self.sessions.values()),
+            "evicted_images": self.evicted_images,
+            "expired_sessions": self.expired_sessions,
+        }
+
+
+def remove_paths(paths):
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f'Failed to delete {path}. Reason: {e}')
+
+
+async def evict_idle_sessions():
+    """
+    Background task: delete the folders of sessions idle for longer than session_ttl
+    """
+    while True:
+        await asyncio.sleep(max(1.0, min(60.0, session_ttl / 4)))
+        folders = sessions.expire()
+        if folders:
+            await run_in_threadpool(remove_paths, folders)
+
+
+sessions = SessionStore([image_dir, derivative_dir, tensor_store.directory], load_session_secret(session_key_file), session_ttl, session_max_images, session_max_bytes, session_max_count)
+
+
+@dataclass
+class Job:
+    id: str
+    priority: int
+    model: str
+    session_id: str
+    items: List[Dict[str, Any]]  # {"image_id": ...} for stored images, {"filename": ..., "data": bytes} for uploads
+    size: int = 0  # images in the job, items are dropped once it finishes
+    bytes: int = 0  # uploaded bytes held in items, counted against the queue's byte budget
+    status: str = "queued"  # queued, running, done, failed or cancelled
+    results: List[Dict[str, Any]] = field(default_factory=list)
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    version: int = 0  # bumped on every change, watchers wait for it to move
+    changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def snapshot(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "model": self.model,
+            "images": self.size,
+            "completed": len(self.results),
+            "results": self.results,
+            "error": self.error,
+            "queue_ms": round(1000 * ((self.started or time.time()) - self.created), 1),
+            "run_ms": round(1000 * ((self.finished or time.time()) - self.started), 1) if self.started else None,
+        }
+
+
+class JobQueue:
+    """
+    In-process priority queue of classification jobs, run by a fixed number of worker tasks.
+    Submitting only enqueues, so clients get a job ID at once and collect results by polling,
+    SSE or WebSocket; bursts wait in the queue instead of holding connections open.
+    Finished jobs are kept for ttl seconds. Job IDs are unguessable and act as the capability to read them.
+    Uploads stay in memory until their job finishes, so unfinished jobs may hold at most max_queued_bytes.
+    """
+    def __init__(self, handler, workers=2, max_queued=10000, max_queued_bytes=256 * 1024 * 1024, ttl=600):
+        self.handler = handler  # async, job -> None, reports progress with add_result()
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+        self.queued_jobs = 0  # status "queued"; cancelled jobs stay in _queue until a worker skips them
+        self.ttl = ttl
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.counts = {"submitted": 0, "done": 0, "failed": 0, "cancelled": 0, "rejected": 0}
+        self.running = 0
+        self.queue_wait = JOB_QUEUE_WAIT
+        self.run_time = JOB_RUN
+        self._queue = None
+        self._tasks = []
+        self._seq = 0
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def queued(self):
+        return self.queued_jobs
+
+    def admit(self, nbytes=0):
+        """
+        Raise a 503 if a job holding nbytes of uploads doesn't fit in the queue now
+        """
+        self._expire()
+        if self.queued() >= self.max_queued or self.queued_bytes + nbytes > self.max_queued_bytes:
+            self.counts["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later", headers={"Retry-After": "5"})
+
+    def submit(self, items, model, session_id, priority=0):
+        """
+        Enqueue a job, higher priority runs first (FIFO within a priority)
+        """
+        nbytes = sum(len(item.get("data", b"")) for item in items)
+        self.admit(nbytes)
+        job = Job(id=secrets.token_urlsafe(12), priority=priority, model=model, session_id=session_id, items=items, size=len(items), bytes=nbytes)
+        self.jobs[job.id] = job
+        self.queued_bytes += nbytes
+        self.queued_jobs += 1
+        self._seq += 1
+        self._queue.put_nowait((-priority, self._seq, job))
+        self.counts["submitted"] += 1
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job.status != "queued":
+            raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+        self.queued_jobs -= 1
+        self._finish(job, "cancelled")  # the worker skips it when it comes up
+        return job
+
+    def add_result(self, job, result):
+        job.results.append(result)
+        self._changed(job)
+
+    async def wait(self, job, version, timeout):
+        """
+        Wait until the job changes after version, returns False on timeout
+        """
+        event = job.changed
+        if job.version > version:
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _changed(self, job):
+        job.version += 1
+        event, job.changed = job.changed, asyncio.Event()
+        event.set()
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        job.items = []  # drop uploaded bytes, results stay
+        self.queued_bytes -= job.bytes
+        job.bytes = 0
+        self.counts[status] += 1
+        self._changed(job)
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [j.id for j in self.jobs.values() if j.done and now - j.finished > self.ttl]:
+            del self.jobs[job_id]
+
+    async def _work(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.status != "queued":
+                continue
+            self.queued_jobs -= 1
+            job.status = "running"
+            job.started = time.time()
+            self.queue_wait.observe(job.started - job.created)
+            self._changed(job)
+            self.running += 1
+            try:
+                await self.handler(job)
+                self._finish(job, "done")
+            except asyncio.CancelledError:
+                self._finish(job, "cancelled")
+                raise
+            except Exception as e:
+                logging.exception(f"Job {job.id} failed")
+                self._finish(job, "failed", str(e))
+            finally:
+                self.running -= 1
+                self.run_time.observe(job.finished - job.started)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self.queued(),
+            "queued_bytes": self.queued_bytes,
+            "running": self.running,
+            "kept": len(self.jobs),
+            **self.counts,
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "run_seconds": self.run_time.snapshot(),
+        }
+
+
+jobs = JobQueue(lambda job: run_job(job), workers=job_workers, max_queued=job_max_queued, max_queued_bytes=job_max_queued_bytes, ttl=job_ttl)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    started = time.perf_counter()
+    # Fetch weights before anything loads them, in parallel and only once for all process workers
+    prefetch = {"preload": model_preload, "all": list(MODEL_BUILDERS), "none": []}[weights_prefetch]
+    startup_timings["prefetch_seconds"] = await run_in_threadpool(weight_cache.prefetch, [MODEL_BUILDERS[n][1].url for n in prefetch])
+    # Load the classifier once so requests never pay for it
+    # (process workers load their own copy instead)
+    load_started = time.perf_counter()
+    if executor.kind == "thread":
+        for name in model_preload:
+            model_registry.load(name)
+    tensor_store.prepare()
+    await run_in_threadpool(sessions.rebuild)
+    await executor.start(model_preload)
+    get_batcher(model_name)
+    jobs.start()
+    startup_timings["load_seconds"] = time.perf_counter() - load_started
+    startup_timings["startup_seconds"] = time.perf_counter() - started
+    logging.info(f"Started in {startup_timings['startup_seconds']:.2f}s (weights {startup_timings['prefetch_seconds']:.2f}s)")
+    eviction = asyncio.create_task(evict_idle_sessions())
+    yield
+    eviction.cancel()
+    await jobs.stop()
+    for batcher in batchers.values():
+        await batcher.stop()
+    executor.shutdown()
+
+
+def parse_derivative_specs(spec):
+    """
+    "thumb=128x128.webp,..." -> [("thumb", (128, 128), "WEBP", "webp"), ...], skipping formats Pillow can't write
+    """
+    derivatives = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, size_ext = item.partition("=")
+        size, _, ext = size_ext.partition(".")
+        image_format = Image.registered_extensions().get(f".{ext.lower()}")
+        if image_format is None or image_format not in Image.SAVE:
+            logging.warning(f"Skipping derivative {name}: Pillow can't write .{ext}")
+            continue
+        width, height = (int(v) for v in size.split("x"))
+        derivatives.append((name, (width, height), image_format, ext.lower()))
+    return derivatives
+
+
+derivative_specs = parse_derivative_specs(image_derivatives)
+
+_etag_cache = {}
+
+def content_etag(path, stat_result):
+    """
+    Strong ETag from the file content, cached per (path, mtime, size).
+    Hashes the file on a miss, so call it from a worker thread
+    """
+    key = (str(path), stat_result.st_mtime_ns, stat_result.st_size)
+    etag = _etag_cache.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        if len(_etag_cache) > 4096:
+            _etag_cache.clear()
+        _etag_cache[key] = etag
+    return etag
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles with content-hash ETags and a fixed Cache-Control policy
+    """
+    def __init__(self, *args, cache_control="no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def lookup_path(self, path):
+        # StaticFiles.get_response runs this in a worker thread, so the ETag is hashed there
+        # and file_response, called on the event loop, finds it cached
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            content_etag(full_path, stat_result)
+        return full_path, stat_result
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        headers = {"etag": f'"{content_etag(full_path, stat_result)}"', "cache-control": self.cache_control}
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+app = FastAPI(title="fastapi-image-app", lifespan=lifespan)
 setup_root_app_directory()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/images", StaticFiles(directory="images"), name="images")
+# Upload names can be reused, so /images revalidates; derivatives have content-hashed names and never change
+app.mount("/images", CachedStaticFiles(directory=image_dir, cache_control="no-cache"), name="images")
+app.mount("/derived", CachedStaticFiles(directory=derivative_dir, cache_control="public, max-age=31536000, immutable"), name="derived")
 
 
 origins = [
@@ -77,17 +1552,136 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
+    """
+    Give every client a session ID (cookie) so uploads are kept per session.
+    The cookie is re-issued whenever a request uses the session, so it expires
+    session_ttl after the last use, like the session's files.
+    """
+    session_id = request.cookies.get(session_cookie) or request.headers.get("x-session-id")
+    is_new = not SessionStore.valid_id(session_id)
+    if is_new:
+        session_id = SessionStore.new_id()
+    request.state.session_id = session_id
+    started = time.time()
+    response = await call_next(request)
+    session = sessions.sessions.get(sessions.key(session_id))
+    if is_new or (session is not None and session.last_seen >= started):
+        response.set_cookie(session_cookie, session_id, max_age=int(session_ttl), httponly=True, samesite="lax")
+    return response
+
+
+# Added last so it is outermost and its latencies include the other middleware
+app.add_middleware(MetricsMiddleware)
 
-def resize_and_save_image(input_path, output_path):
+
+
+def resize_and_save_image(source, output_path, fast=None):
     """
-    Resize an image to 512x512 pixels and save it to the specified output path.
+    Resize an image to resize_target (512x512) and save it to the specified output path.
+    source is a path or a file object (e.g. the spooled upload buffer), returns stage timings in ms.
+    In fast mode JPEGs are decoded at a reduced DCT scale and large images are reduced
+    with a cheap box filter down to 2x the target before the final filter runs.
     """
-    with Image.open(input_path) as img:
+    fast = resize_fast if fast is None else fast
+    reducing_gap = 2.0 if fast else None
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(source) as img:
+        if fast:
+            img.draft('RGB', (int(resize_target[0] * reducing_gap), int(resize_target[1] * reducing_gap)))  # JPEG only
+        img.load()
+        timings["decode_ms"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
         if img.mode != 'RGB':
             img = img.convert('RGB')
-        resized_img = img.resize((512, 512), Image.Resampling.LANCZOS)
-        resized_img.save(output_path)
-    os.remove(input_path)  # Remove the temporary file
+        resized_img = img.resize(resize_target, resize_filter, reducing_gap=reducing_gap)
+        timings["resize_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    encoded = io.BytesIO()
+    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower(), "PNG")
+    options = {"quality": resize_quality} if image_format in ("JPEG", "WEBP") else {}
+    resized_img.save(encoded, format=image_format, **options)
+    timings["encode_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    with open(output_path, "wb") as f:
+        f.write(encoded.getbuffer())
+    timings["write_ms"] = (time.perf_counter() - start) * 1000
+    return timings
+
+
+
+def generate_derivatives(image_path, out_dir):
+    """
+    Write the configured derivatives of a stored image into out_dir, returns {name: url}.
+    File names carry a hash of their content, so a URL always means the same bytes.
+    """
+    stem = os.path.basename(image_path)
+    urls = {}
+    with Image.open(image_path) as img:
+        img.load()
+        for name, size, image_format, ext in derivative_specs:
+            encoded = io.BytesIO()
+            resized = img if img.size == size else img.resize(size, resize_filter, reducing_gap=2.0)
+            options = {"quality": resize_quality} if image_format in ("JPEG", "WEBP", "AVIF") else {}
+            resized.save(encoded, format=image_format, **options)
+            digest = hashlib.sha256(encoded.getbuffer()).hexdigest()[:16]
+            filename = f"{stem}.{digest}.{name}.{ext}"
+            path = os.path.join(out_dir, filename)
+            if not os.path.exists(path):
+                tmp = temp_path(path)
+                with open(tmp, "wb") as f:
+                    f.write(encoded.getbuffer())
+                os.replace(tmp, path)
+            urls[name] = path_url(path)
+    return urls
+
+
+def path_url(path):
+    """URL of a file under a mounted folder, percent-encoded since upload names may contain # ? or %"""
+    return "/" + quote(path)
+
+
+
+def estimate_decode_bytes(source):
+    """
+    Peak memory needed to decode and resize an image, read from its header only
+    """
+    with Image.open(source) as img:
+        if resize_fast:
+            img.draft('RGB', (resize_target[0] * 2, resize_target[1] * 2))  # only changes the reported size
+        pixels = img.width * img.height
+        bands = len(img.getbands())
+        convert = pixels * 3 if img.mode != 'RGB' else 0
+    source.seek(0)
+    return pixels * bands + convert + resize_target[0] * resize_target[1] * 3
+
+
+
+class MemoryBudget:
+    """
+    Async byte budget shared by concurrent decodes, acquire waits until enough is released
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        if n > self.limit:
+            raise HTTPException(status_code=413, detail=f"Image needs {n} bytes to decode, limit is {self.limit}")
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n):
+        async with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+upload_memory = MemoryBudget(upload_max_memory)
 
 
 
@@ -103,75 +1697,43 @@ def download_file_from_link(url, filename=None):
     os.makedirs("models", exist_ok=True)
     save_path = os.path.join("models", filename)
     try:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()  # Raises an HTTPError for bad responses
-            with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
+        download_with_resume(url, save_path)  # picks up where an earlier attempt stopped
         print(f"File downloaded successfully: {save_path}")
     except requests.exceptions.HTTPError as err:
         print(f"Error downloading the file: {err}")
 
 
 
-
-def print_folder_contents(folder_path):
+async def clear_uploaded_images(session_id):
     """
-    To inspect server directory on button click
+    Delete the images of one session, other sessions are left alone
     """
-    if os.path.exists(folder_path):
-        print(f"Contents of {folder_path}:")
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            print(f" - {file_path}")
-    else:
-        print(f"Folder {folder_path} does not exist.")
-
+    await run_in_threadpool(remove_paths, sessions.clear(session_id))
 
 
-def clear_uploaded_images():
+def print_session_images(session_id):
     """
-    Clear on client login for simplicity (danger)
+    Print a session's images from the index, without listing its folder
     """
-    global file_urls
-    file_urls = []
-    global upload_data
-    upload_data = []
-    global image_dir
-    if os.path.exists(image_dir):
-        for filename in os.listdir(image_dir):
-            file_path = os.path.join(image_dir, filename)
-            print(f"Attempting to delete: {file_path}")  # Add logging
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                    print(f"Deleted: {file_path}")  # Success logging
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                    print(f"Deleted directory: {file_path}")  # Success logging
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}') # Failed logging
-
+    print(f"Contents of {sessions.folder(session_id)}:")
+    for image in sessions.listing(session_id):
+        print(f" - {image['url'].lstrip('/')} ({image['bytes']} bytes)")
 
 
-def find_last_uploaded_image(images_dir):
-    images_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), images_dir)
-    image_files = glob.glob(os.path.join(images_path, '*'))
-    if not image_files:
-        return None  
-    latest_image = max(image_files, key=os.path.getmtime)
-    return os.path.relpath(latest_image, images_path)
 
+def find_last_uploaded_image(session_id):
+    """
+    Newest image of a session from the index, instead of globbing and stat-ing its folder
+    """
+    return sessions.latest(session_id)
 
 
 
 @app.get("/")
-def read_root():
-    global image_dir
-
-    clear_uploaded_images()
-    print_folder_contents(image_dir)
-            
+def read_root(request: Request):
+    session_id = request.state.session_id
+    sessions.touch(session_id, create=False)  # a reload keeps the session's uploads
+    print_session_images(session_id)
     return FileResponse("static/index.html")
 
 
@@ -186,49 +1748,523 @@ def create_upload_file(file: UploadFile = UploadFile(...)):
     return {"filename": file.filename}
 
 
+async def _store_upload(file, request_memory, session_id):
+    """
+    Decode the upload straight from its spooled buffer, within the request and global memory caps
+    """
+    file_location = f"{sessions.folder(session_id)}/{os.path.basename(file.filename)}"
+    needed = await run_in_threadpool(estimate_decode_bytes, file.file)
+    start = time.perf_counter()
+    await request_memory.acquire(needed)
+    try:
+        await upload_memory.acquire(needed)
+    except BaseException:
+        await request_memory.release(needed)
+        raise
+    wait_ms = (time.perf_counter() - start) * 1000
+    try:
+        # Process workers can't share the spooled file, so they get a picklable copy
+        # (UploadFile.read moves to a thread once the upload has spilled to disk)
+        source = file.file if executor.kind == "thread" else io.BytesIO(await file.read())
+        timings = await executor.run(resize_and_save_image, source, file_location)
+        observe_image_stages(timings)
+    finally:
+        await upload_memory.release(needed)
+        await request_memory.release(needed)
+    image_id = os.path.basename(file_location)
+    if precompute_tensors:
+        # Classifying by ID can then skip decode and transforms
+        timings["tensor_ms"] = await executor.run(_write_preprocessed_tensor, model_name, file_location, tensor_store.path(sessions.key(session_id), image_id))
+    start = time.perf_counter()
+    derivatives = await executor.run(generate_derivatives, file_location, sessions.folder(session_id, derivative_dir))
+    timings["derivatives_ms"] = (time.perf_counter() - start) * 1000
+    paths = [file_location] + [unquote(url).lstrip("/") for url in derivatives.values()]
+    if precompute_tensors:
+        paths.append(tensor_store.path(sessions.key(session_id), image_id))
+    info = await executor.run(file_info, paths)  # sizes and hash for the index, off the event loop
+    return {"filename": file.filename, "memory_wait_ms": wait_ms, **timings, "derivatives": derivatives, "paths": paths, "info": info}
+
+
+
 @app.post("/uploadimages/")
-async def upload_images(files: List[UploadFile] = File(...)):
-    global upload_data
-    global file_urls
-    for file in files:
-        if file.content_type not in ["image/jpg", "image/jpeg", "image/png"]:
-            raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
+async def upload_images(request: Request):
+    session_id = request.state.session_id
+    content_length = int(request.headers.get("content-length", 0))
+    if content_length > upload_max_body_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload of {content_length} bytes exceeds {upload_max_body_bytes}")
+
+    start = time.perf_counter()
+    async with request.form() as form:
+        receive_ms = (time.perf_counter() - start) * 1000
+        files = [f for f in form.getlist("files") if isinstance(f, StarletteUploadFile)]
+        UPLOAD_BYTES.inc(sum(file.size or 0 for file in files))
+        if not files:
+            raise HTTPException(status_code=400, detail="No files uploaded")
+        for file in files:
+            if file.content_type not in ["image/jpg", "image/jpeg", "image/png"]:
+                raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
+        if len(files) > session_max_images:
+            raise HTTPException(status_code=413, detail=f"At most {session_max_images} images per session")
+
+        # Files of one request are decoded concurrently, bounded by the memory caps
+        request_memory = MemoryBudget(upload_max_request_memory)
+        sessions.touch(session_id)
+        await run_in_threadpool(sessions.make_folders, session_id)
+        try:
+            timings = await asyncio.gather(*(_store_upload(file, request_memory, session_id) for file in files))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to process the upload: {str(e)}")
+
+    derivatives = {}
+    garbage = []
+    for file, stage_timings in zip(files, timings):
+        stage_timings["receive_ms"] = receive_ms
+        name = os.path.basename(file.filename)
+        file_url = path_url(os.path.join(sessions.folder(session_id), name))
+        derivatives[file_url] = stage_timings.pop("derivatives")
+        garbage += sessions.add(session_id, name, file_url, derivatives[file_url], stage_timings.pop("paths"), stage_timings.pop("info"))
+    await run_in_threadpool(remove_paths, garbage)  # replaced derivatives and images over the session quota
+
+    return JSONResponse(content={"upload callback": "Files uploaded successfully", "image_urls": sessions.image_urls(session_id), "derivatives": derivatives, "timings": timings})
+
+
+@app.get("/images")
+def list_images(request: Request):
+    """The caller's uploaded images, newest last, from the in-memory index"""
+    session_id = request.state.session_id
+    return {"images": sessions.listing(session_id), "latest": sessions.latest(session_id)}
+
+
+@app.delete("/images")
+async def delete_images(request: Request):
+    """Delete the caller's uploaded images"""
+    await clear_uploaded_images(request.state.session_id)
+    return {"status": "cleared"}
+
+
+
+
+async def classify_image_bytes(image_data, name, load_tensor=None):
+    """
+    Top-k predictions of model name for encoded image bytes, served from the result cache when possible.
+    load_tensor may return the already preprocessed tensor (or None) to skip decoding.
+    """
+    cache_key = ResultCache.key(image_data, model_cache_id(name))
+    top_k = result_cache.get(cache_key) # Same bytes, same model: skip the forward pass
+    if top_k is None:
+        tensor = load_tensor() if load_tensor else None
+        if tensor is None:
+            tensor = await executor.run(_preprocess_image_bytes, name, image_data) # Decode and transform off the event loop
+        prediction = await get_batcher(name).submit(tensor) # Shares a forward pass with concurrent requests
+        top_k = top_k_predictions(prediction, MODEL_BUILDERS[name][1].meta["categories"], classify_top_k)
+        result_cache.put(cache_key, top_k)
+    return top_k
+
+
+def format_classification(top_k):
+    return f"Category: {top_k[0]['category']}, Score: {100 * top_k[0]['score']:.1f}%"
+
+
+def resolve_image_id(image_id, session_id):
+    """
+    Map an image ID (a file name in the session's folder, or "latest") to its path on disk
+    """
+    if image_id == "latest":
+        image_id = find_last_uploaded_image(session_id)
+        if image_id is None:
+            raise HTTPException(status_code=404, detail="No uploaded images")
+    if os.path.basename(image_id) != image_id or image_id.startswith("."):
+        raise HTTPException(status_code=400, detail=f"Invalid image ID: {image_id}")
+    if sessions.image(session_id, image_id) is None:
+        raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+    return image_id, os.path.join(sessions.folder(session_id), image_id)
+
 
-        file_location = f"{image_dir}/{file.filename}"
-        temp_file_path = file_location + ".tmp"
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
-        resize_and_save_image(temp_file_path, file_location)
-        file_url = f"/{image_dir}/{file.filename}"
-        file_urls.append(file_url)
-        await file.close()
 
-    return JSONResponse(content={"upload callback": "Files uploaded successfully", "image_urls": file_urls})
+async def classify_stored_image(image_id, session_id, name):
+    image_id, path = resolve_image_id(image_id, session_id)
+    top_k = await classify_image_bytes(
+        await executor.run(_read_file, path),
+        name,
+        # Stored tensors are made with the default model's transforms
+        load_tensor=(lambda: tensor_store.load(sessions.key(session_id), image_id, path)) if name == model_name else None,
+    )
+    return {"image_id": image_id, "model": name, "classification": format_classification(top_k), "top_k": top_k}
 
 
+class ClassifyRequest(BaseModel):
+    image_ids: List[str]
+    model: Optional[str] = None
+
 
 
 @app.post("/process-last-image")
-async def process_last_image(image: UploadFile = File(...)):
+async def process_last_image(image: UploadFile = File(...), model: Optional[str] = None):
     try:
         print("Starting classification: ")
-        # Same as official PyTorch example:
-        weights = ViT_L_32_Weights.DEFAULT # .IMAGENET1K_V1
-        model = vit_l_32(weights=weights)
-        preprocess = weights.transforms() # Step 2: Initialize the inference transforms
-        print("Preprocess object: ", preprocess)
-        image_data = await image.read()
-        img = Image.open(io.BytesIO(image_data))
-        batch = preprocess(img).unsqueeze(0) # Step 3: Apply inference preprocessing transforms
-        prediction = model(batch).squeeze(0).softmax(0) # Step 4: Use the model and print the predicted category
-        class_id = prediction.argmax().item()
-        score = prediction[class_id].item()
-        category_name = weights.meta["categories"][class_id]
-        classification_str = str(f"Category: {category_name}, Score: {100 * score:.1f}%")
+        # Same as official PyTorch example, but the model is loaded once and kept warm
+        top_k = await classify_image_bytes(await image.read(), resolve_model_name(model))
+        classification_str = format_classification(top_k)
         print(classification_str)
-        return JSONResponse(content={"processing callback": "worked!", "classification": classification_str})
+        return JSONResponse(content={"processing callback": "worked!", "classification": classification_str, "top_k": top_k})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to process the image: {str(e)}")
+
+
+
+@app.post("/classify")
+async def classify_images(body: ClassifyRequest, request: Request):
+    """Classify several stored images, they share forward passes through the micro-batcher"""
+    try:
+        name = resolve_model_name(body.model)
+        results = await asyncio.gather(*(classify_stored_image(image_id, request.state.session_id, name) for image_id in body.image_ids))
+        return {"results": results}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to process the images: {str(e)}")
+
+
+async def classify_batch(name, images, k, load_tensors=None):
+    """
+    Classify several encoded images in one forward pass (after the result cache), returns their top-k lists
+    and stage timings. load_tensors may hold one function per image returning its preprocessed tensor (or None).
+    """
+    timings = {}
+    keys = [ResultCache.key(data, model_cache_id(name)) for data in images]
+    # the cache holds classify_top_k entries, enough for any k up to that
+    results = [result_cache.get(key) if k <= classify_top_k else None for key in keys]
+    results = [r[:k] if r is not None else None for r in results]
+    misses = [i for i, r in enumerate(results) if r is None]
+    if misses:
+        start = time.perf_counter()
+        tensors = {i: load_tensors[i]() if load_tensors else None for i in misses}
+        decode = [i for i in misses if tensors[i] is None]
+        # Split decoding across the executor's workers
+        chunks = [decode[w::executor.workers] for w in range(executor.workers) if decode[w::executor.workers]]
+        decoded = await asyncio.gather(*(executor.run(_preprocess_images, name, [images[i] for i in chunk]) for chunk in chunks))
+        for chunk, batch in zip(chunks, decoded):
+            for i, tensor in zip(chunk, batch):
+                tensors[i] = tensor
+        batch = [tensors[i] for i in misses]  # stacked by the worker
+        timings["preprocess_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+        await ensure_loaded(name)
+        start = time.perf_counter()
+        scores, class_ids = await executor.run(_classify_batch_top_k, name, batch, max(k, classify_top_k))
+        timings["inference_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        INFERENCE.labels(name).observe(timings["inference_ms"] / 1000)
+
+        start = time.perf_counter()
+        for i, top_k in zip(misses, top_k_batch(scores, class_ids, MODEL_BUILDERS[name][1].meta["categories"])):
+            result_cache.put(keys[i], top_k[:classify_top_k])
+            results[i] = top_k[:k]
+        timings["postprocess_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    timings["cached"] = len(images) - len(misses)
+    return results, timings
 
+
+@app.post("/classify/batch")
+async def classify_image_batch(request: Request, model: Optional[str] = None, top_k: int = classify_top_k):
+    """
+    Classify up to CLASSIFY_BATCH_MAX images as one tensor batch: multipart "files", or stored images
+    as JSON like /classify. Returns structured top-k labels and scores for each, in request order.
+    """
+    session_id = request.state.session_id
+    if top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1")
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        if int(request.headers.get("content-length", 0)) > upload_max_body_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {upload_max_body_bytes} bytes")
+        async with request.form() as form:
+            files = [f for f in form.getlist("files") if isinstance(f, StarletteUploadFile)]
+            if len(files) > classify_batch_max:
+                raise HTTPException(status_code=413, detail=f"At most {classify_batch_max} images per batch")
+            name = resolve_model_name(model or form.get("model"))
+            ids = [file.filename for file in files]
+            images = [await file.read() for file in files]
+        load_tensors = None
+    else:
+        try:
+            body = ClassifyRequest(**await request.json())
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if len(body.image_ids) > classify_batch_max:
+            raise HTTPException(status_code=413, detail=f"At most {classify_batch_max} images per batch")
+        name = resolve_model_name(model or body.model)
+        ids, paths = zip(*(resolve_image_id(image_id, session_id) for image_id in body.image_ids)) if body.image_ids else ((), ())
+        images = await asyncio.gather(*(executor.run(_read_file, path) for path in paths))
+        # Stored tensors are made with the default model's transforms
+        load_tensors = [partial(tensor_store.load, sessions.key(session_id), i, p) for i, p in zip(ids, paths)] if name == model_name else None
+    if not images:
+        raise HTTPException(status_code=400, detail="No images")
+    try:
+        results, timings = await classify_batch(name, images, top_k, load_tensors)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to process the images: {str(e)}")
+    return {
+        "model": name,
+        "results": [{"image_id": image_id, "top_k": result} for image_id, result in zip(ids, results)],
+        "timings": timings,
+    }
+
+
+@app.post("/classify/{image_id}")
+async def classify_image(image_id: str, request: Request, model: Optional[str] = None):
+    """Classify an image already stored by /uploadimages/ ("latest" for the newest one)"""
+    try:
+        return await classify_stored_image(image_id, request.state.session_id, resolve_model_name(model))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process the image: {str(e)}")
 
+async def classify_job_item(job, index, item):
+    """
+    One image of a job. Waits and retries while the executor is saturated instead of failing,
+    other errors are reported on the item
+    """
+    delay = 0.05
+    while True:
+        try:
+            if "data" in item:
+                top_k = await classify_image_bytes(item["data"], job.model)
+                result = {"filename": item["filename"], "model": job.model, "classification": format_classification(top_k), "top_k": top_k}
+            else:
+                result = await classify_stored_image(item["image_id"], job.session_id, job.model)
+            break
+        except HTTPException as e:
+            if e.status_code != 503:
+                result = {"image_id": item.get("image_id", item.get("filename")), "error": e.detail}
+                break
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 2.0)
+        except Exception as e:
+            result = {"image_id": item.get("image_id", item.get("filename")), "error": str(e)}
+            break
+    jobs.add_result(job, {"index": index, **result})
+
+
+async def run_job(job):
+    # A chunk of images is submitted together so they share forward passes through the micro-batcher,
+    # without flooding the executor with a whole large job at once
+    for start in range(0, len(job.items), job_chunk_size):
+        chunk = job.items[start:start + job_chunk_size]
+        await asyncio.gather(*(classify_job_item(job, start + i, item) for i, item in enumerate(chunk)))
+
+
+async def job_updates(job, keepalive=15):
+    """
+    Yields the job's state on every change until it finishes (results only once each, match them by "index"),
+    and None after keepalive seconds without a change
+    """
+    version, sent = -1, 0
+    while True:
+        if job.version > version:
+            version = job.version
+            update = {**job.snapshot(), "results": job.results[sent:]}
+            sent += len(update["results"])
+            yield update
+            if job.done:
+                return
+        else:
+            yield None
+        await jobs.wait(job, version, keepalive)
+
+
+class JobRequest(BaseModel):
+    image_ids: List[str]
+    model: Optional[str] = None
+    priority: int = 0
+
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    """
+    Queue a classification and return its ID at once: stored images as JSON (like /classify, plus "priority")
+    or uploads as multipart "files" with optional "model" and "priority" fields. Higher priority runs first.
+    """
+    session_id = request.state.session_id
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        if int(request.headers.get("content-length", 0)) > upload_max_body_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {upload_max_body_bytes} bytes")
+        async with request.form() as form:
+            files = [f for f in form.getlist("files") if isinstance(f, StarletteUploadFile)]
+            if not files:
+                raise HTTPException(status_code=400, detail="No files uploaded")
+            if len(files) > job_max_images:
+                raise HTTPException(status_code=413, detail=f"At most {job_max_images} images per job")
+            for file in files:
+                if file.content_type not in ["image/jpg", "image/jpeg", "image/png"]:
+                    raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
+            try:
+                body = JobRequest(image_ids=[], model=form.get("model") or None, priority=form.get("priority") or 0)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            jobs.admit(sum(file.size or 0 for file in files))  # before the uploads are copied into memory
+            items = [{"filename": file.filename, "data": await file.read()} for file in files]
+    else:
+        try:
+            body = JobRequest(**await request.json())
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if not body.image_ids:
+            raise HTTPException(status_code=400, detail="No image IDs")
+        if len(body.image_ids) > job_max_images:
+            raise HTTPException(status_code=413, detail=f"At most {job_max_images} images per job")
+        # Checked now so a typo fails the request, not the job ("latest" is pinned to today's latest)
+        items = [{"image_id": resolve_image_id(image_id, session_id)[0]} for image_id in body.image_ids]
+    job = jobs.submit(items, resolve_model_name(body.model), session_id, body.priority)
+    links = {"poll": f"/jobs/{job.id}", "events": f"/jobs/{job.id}/events", "websocket": f"/jobs/{job.id}/ws"}
+    return JSONResponse(status_code=202, content={**job.snapshot(), **links}, headers={"Location": links["poll"]})
+
+
+@app.get("/jobs/stats")
+def job_stats():
+    """Queue length, outcomes and wait/run time histograms of /jobs"""
+    return jobs.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Poll a job, ?wait=N holds the request up to N seconds (max 30) until it finishes"""
+    job = jobs.get(job_id)
+    deadline = time.monotonic() + min(wait, 30)
+    while not job.done and time.monotonic() < deadline:
+        await jobs.wait(job, job.version, deadline - time.monotonic())
+    return job.snapshot()
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    """Cancel a job that hasn't started yet"""
+    return jobs.cancel(job_id).snapshot()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """Server-Sent Events: one event per state change (named after the status) until the job finishes"""
+    job = jobs.get(job_id)
+
+    async def stream():
+        async for update in job_updates(job):
+            if update is None:
+                if await request.is_disconnected():
+                    return
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {update['status']}\ndata: {json.dumps(update)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/jobs/{job_id}/ws")
+async def job_websocket(websocket: WebSocket, job_id: str):
+    """Same updates as /events as JSON messages, closed once the job finishes"""
+    job = jobs.jobs.get(job_id)
+    if job is None:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    disconnected = asyncio.create_task(wait_for_disconnect(websocket))
+    updates = job_updates(job)
+    try:
+        while True:
+            update = asyncio.ensure_future(updates.__anext__())
+            await asyncio.wait({update, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():  # stop watching a job nobody listens to
+                update.cancel()
+                await asyncio.gather(update, return_exceptions=True)
+                return
+            try:
+                update = update.result()
+            except StopAsyncIteration:
+                break
+            if update is not None:
+                await websocket.send_json(update)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnected.cancel()
+        await updates.aclose()
+
+
+async def wait_for_disconnect(websocket):
+    """Returns once the client disconnects, messages from it are ignored"""
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+
+@app.get("/models")
+async def list_models():
+    """Models a request can pick with ?model=, and which of them are resident (in any worker with EXECUTOR=process)"""
+    if executor.kind == "process":
+        resident = sorted({name for stats in (await executor.worker_stats()).values() for name in stats["models"]})
+    else:
+        resident = list(model_registry.stats())
+    return {"default": model_name, "available": list(MODEL_BUILDERS), "resident": resident}
+
+
+@app.get("/models/stats")
+async def model_stats():
+    """
+    Load time and memory of the resident models. With EXECUTOR=process the models live in the workers:
+    "workers" has their stats by PID and the top-level figures describe the server process.
+    """
+    stats = {"executor": executor.kind, **registry_stats(), "memory_budget_bytes": model_registry.memory_budget}
+    if executor.kind == "process":
+        workers = await executor.worker_stats()
+        stats["workers"] = {str(pid): workers[pid] for pid in sorted(workers)}
+        stats["workers_missing"] = executor.workers - len(workers)  # too busy to answer, try again
+    stats["startup"] = {k: round(v, 3) for k, v in startup_timings.items()}
+    stats["weights"] = weight_cache.stats()
+    return stats
+
+
+@app.get("/batching/stats")
+def batching_stats():
+    """Batch-size and queue-wait histograms of the micro-batchers, per model"""
+    return {name: batcher.stats() for name, batcher in batchers.items()}
+
+
+@app.get("/executor/stats")
+def executor_stats():
+    """Pending, completed and rejected jobs of the inference executor"""
+    return executor.stats()
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit/miss counters and size of the classification result cache"""
+    return result_cache.stats()
+
+
+@app.get("/tensors/stats")
+def tensor_stats():
+    """Hits and misses of the precomputed tensor store"""
+    return tensor_store.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text format: per-route request counts and latency, upload and image stage timings, inference time"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/sessions/stats")
+def session_stats():
+    """Sessions, stored images and quota evictions"""
+    return sessions.stats()
@@ -21,7 +21,10 @@ document.getElementById('uploadform').addEventListener('submit', async function(
                 const img = document.createElement('img');
                 img.style.height = '100%';
                 img.style.maxWidth = '100%';
-                img.src = url;
+                // Prefer the small, long-cached derivative over the original upload
+                const derived = data.derivatives && data.derivatives[url];
+                img.src = (derived && derived.medium) || url;
+                img.dataset.imageId = decodeURIComponent(url.split('/').pop()); // URLs come percent-encoded
                 img.id = 'uploadedImage';
                 placeholder.appendChild(img);
             });
@@ -39,15 +42,10 @@ document.getElementById('process_1').addEventListener('click', async () => {
     const placeholder = document.querySelector('.imageplaceholder1');
     const imgElement = placeholder.querySelector('img:last-child');
     if (imgElement) {
-        const imageUrl = imgElement.src;
-        const response = await fetch(imageUrl);
-        const imageBlob = await response.blob();
-        const formData = new FormData();
-        formData.append('image', imageBlob, 'image.png');
-        console.log("New form data: ", formData);
-        const processResponse = await fetch('/process-last-image', {
+        // The server already stores the image, so only send its ID
+        const imageId = imgElement.dataset.imageId;
+        const processResponse = await fetch('/classify/' + encodeURIComponent(imageId), {
             method: 'POST',
-            body: formData, 
         });
         if (processResponse.ok) {
             const data = await processResponse.json();
@@ -65,4 +63,3 @@ document.getElementById('process_1').addEventListener('click', async () => {
         console.error('No image to process');
     }
 });
-